@@ -9,9 +9,6 @@ import sys
 
 toplevelaccounts = ['Asset', 'Equity', 'Expense', 'Income', 'Liability']
 
-missingaccounts = ['Fixed Asset', 'Other Current Liability', 'Other Income', 'Other Expense', 'Non-Posting',
-                   'Other Current Asset', 'Cost of Goods Sold']
-
 infieldnames = ['Active Status', 'Account', 'Type', 'Balance Total', 'Description', 'Tax Line']
 outfieldnames = ['type', 'full_name', 'name', 'code', 'description', 'color', 'notes', 'commoditym', 'commodityn',
                  'hidden', 'tax', 'place_holder']
@@ -94,6 +91,47 @@ def getname(atype, usetype, name, parent):
     return fullname, name
 
 
+def compile_fieldmap():
+    """Compile fieldmap into the constant columns and (column, transform) pairs for the rest.
+
+    Each transform takes a QuickBooks row. full_name and name share one getname call per row.
+    """
+    typefield = fieldmap['type']
+    namefield = fieldmap['full_name']
+    last = [None, None]
+
+    def names(row):
+        # getname for this row, remembered for the next column
+        key = (row[typefield], row[namefield])
+        if key != last[0]:
+            last[0] = key
+            last[1] = getname(key[0], useaccount[key[0]], key[1], parentmap[key[0]])
+        return last[1]
+
+    constants = {}
+    transforms = []
+    for iout in outfieldnames:
+        field = fieldmap[iout]
+        if field == 'not mapped':
+            continue
+        elif iout == 'type':
+            transform = lambda row: accountmap[row[typefield]]
+        elif iout == 'full_name':
+            transform = lambda row: names(row)[0]
+        elif iout == 'name':
+            transform = lambda row: names(row)[1]
+        elif iout == 'hidden':
+            transform = lambda row, field=field: 'F' if row[field] == 'Active' else 'T'
+        elif field in infieldnames:
+            transform = itemgetter(field)
+        else:
+            # commoditym commodityn tax place_holder
+            constants[iout] = field
+            continue
+        transforms.append((iout, transform))
+    return constants, transforms
+
+
 def lfind(f, seq):
     """Return first item in sequence where f(item) == True."""
     for item in seq:
@@ -112,85 +150,168 @@ def main():
     parser.add_argument('outfile',
                         metavar='outfile.csv',
                         nargs=1,
-                        help='gnucash account import file')
+                        help='gnucash account import file, or with --gnucash an existing gnucash book')
+    parser.add_argument('-g', '--gnucash',
+                        action='store_true',
+                        help='Create the accounts directly in the gnucash book outfile')
+    parser.add_argument('--test',
+                        action='store_false',
+                        help='With --gnucash, create the accounts but do not save the book')
     args = parser.parse_args()
     infile = args.infile[0]
     outfile = args.outfile[0]
 
-    # Add top level accounts to output list
-    out = []
-    for iout in toplevelaccounts:
-        name = parentmap[str(iout)]
-        name = name.split(':')[0]
-        out.append(dict(name=name, commodityn='CURRENCY', commoditym='USD', tax='F', full_name=name, hidden='F',
-                        type=accountmap[str(iout)], place_holder='T', description=''))
-    # Add missing mid-level accounts to output list
-    for iout in missingaccounts:
-        parent = parentmap[str(iout)]
-        name = iout
-        fullname = parent + name
-        out.append(dict(name=name, commodityn='CURRENCY', commoditym='USD', tax='F', full_name=fullname, hidden='F',
-                        type=accountmap[str(iout)], place_holder='F', description=''))
+    with open(infile) as csvfile:
+        out = gnc_accounts(csv.DictReader(csvfile))
 
-    # Initialize the output list and write the header
+    if args.gnucash:
+        # Only this mode needs the gnucash bindings
+        from tax import GncFile
+        GncFile.nosave = args.test
+        GncFile.gnc_open(outfile)
+        try:
+            created = add_accounts(GncFile.book, out)
+            GncFile.gnc_save()
+        finally:
+            GncFile.gnc_end()
+        print '%d accounts created in %s' % (created, outfile)
+        return
+
+    # Write the header and the accounts
     with open(outfile, 'w') as csvout:
         writer = csv.DictWriter(csvout, fieldnames=outfieldnames, dialect='excel')
         writer.writeheader()
+        writer.writerows(out)
+
+
+def gnc_accounts(reader):
+    """Return gnucash account rows for QuickBooks account rows, parents before children."""
+    tree = AccountNode()
+
+    # Add top level accounts to the tree
+    for iout in toplevelaccounts:
+        name = parentmap[str(iout)]
+        name = name.split(':')[0]
+        tree.insert(dict(name=name, commodityn='CURRENCY', commoditym='USD', tax='F', full_name=name, hidden='F',
+                         type=accountmap[str(iout)], place_holder='T', description=''))
+
+    # Process the input rows
+    constants, transforms = compile_fieldmap()
+    for row in reader:
+        outrow = dict(constants)
+        for column, transform in transforms:
+            outrow[column] = transform(row)
+
+        # Add row to the tree, creating any missing parents
+        tree.insert(outrow)
+
+    # Report parents QuickBooks did not list
+    for fullname in tree.orphans():
+        print >> sys.stderr, 'Account "%s" is not in the QuickBooks accounts; created as a placeholder' % fullname
+    return tree.walk()
+
+
+class AccountNode(object):
+    """Trie of accounts keyed by the parts of their full names."""
+    __slots__ = ('row', 'children', 'auto')
+
+    def __init__(self):
+        self.row = None
+        self.children = {}
+        self.auto = False
+
+    def insert(self, row):
+        node = self
+        names = row['full_name'].split(':')
+        for depth in range(len(names)):
+            child = node.children.get(names[depth])
+            if child is None:
+                child = node.children[names[depth]] = AccountNode()
+            if depth < len(names) - 1 and child.row is None:
+                # Placeholder parent of the child's type, replaced if its own row turns up later
+                child.row = dict(name=names[depth], commodityn=row['commodityn'], commoditym=row['commoditym'],
+                                 tax='F', full_name=':'.join(names[:depth + 1]), hidden='F', type=row['type'],
+                                 place_holder='T', description='')
+                child.auto = True
+            node = child
+        if node.row is not None and not node.auto:
+            print >> sys.stderr, 'Account "%s" is listed more than once; keeping the first' % row['full_name']
+            return
+        node.row = row
+        node.auto = False
+
+    def orphans(self):
+        """Return full names of placeholders created for parents QuickBooks did not list."""
+        found = []
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            # Parents named after an account type, e.g. Assets:Fixed Asset, are expected
+            if node.auto and not (depth == 2 and node.row['name'] in accountmap):
+                found.append(node.row['full_name'])
+            stack.extend((child, depth + 1) for child in node.children.itervalues())
+        return sorted(found)
+
+    def walk(self):
+        """Yield the account rows depth first, each account's children sorted by name."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.row is not None:
+                yield node.row
+            stack.extend(node.children[name] for name in sorted(node.children, reverse=True))
+
+
+def add_accounts(book, rows):
+    """Create gnucash account rows, as from gnc_accounts, in a gnucash book.
+
+    Rows are expected parents first and each full name is created once:
+    accounts already in the book are reused, and a missing parent is created
+    as a placeholder of its child's type. Returns the number of accounts
+    created.
+    """
+    from gnucash import Account
+    from gnucash import gnucash_core_c
+
+    root = book.get_root_account()
+    commodities = {}
+    accounts = {}
+
+    def index(parent, prefix):
+        for child in parent.get_children():
+            fullname = prefix + child.GetName()
+            accounts[fullname] = child
+            index(child, fullname + ':')
+    index(root, '')
+
+    created = 0
+    for row in rows:
+        key = (row['commodityn'], row['commoditym'])
+        if key not in commodities:
+            commodities[key] = book.get_table().lookup(*key)
+        atype = getattr(gnucash_core_c, 'ACCT_TYPE_' + row['type'])
 
-        # Process the input file
-        with open(infile) as csvfile:
-            # with open('emerald_accounts.CSV') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-
-                # reserve variables for loop tests in fieldmap
-                atype = ' '
-                oname = ' '
-                outrow = {}
-
-                # Map the output field names using fieldmap
-                for iout in outfieldnames:
-                    field = fieldmap[str(iout)]
-
-                    # Determine account type for use in later fields
-                    # and assign re-mapped account type to output dictionary
-                    if iout == outfieldnames[0]:
-                        atype = row[str(field)]
-                        outrow[str(iout)] = accountmap[str(atype)]
-
-                    # Determine name, full name, parent account and whether type added to full name.
-                    # Assign generated full name to output dictionary.
-                    elif iout == outfieldnames[1] and atype != ' ':
-                        usetype = useaccount[str(atype)]
-                        name = row[str(field)]
-                        # account = accountmap[ str(type) ]
-                        parent = parentmap[str(atype)]
-                        ofull_name, oname = getname(atype, usetype, name, parent)
-                        outrow[str(iout)] = ofull_name
-
-                    # Assign account name to output dictionary
-                    elif iout == outfieldnames[2] and oname != ' ':
-                        outrow[str(iout)] = oname
-
-                    # Assign Description to output dictionary
-                    elif iout == outfieldnames[4] and oname != ' ':
-                        outrow[str(iout)] = row[str(field)]
-
-                    # commoditym commodityn hidden tax place_holder
-                    elif iout == outfieldnames[9]:
-                        if row[str(field)] == 'Active':
-                            outrow[str(iout)] = 'F'
-                        else:
-                            outrow[str(iout)] = 'T'
-                    elif field == 'not mapped':
-                        continue
-                    else:
-                        outrow[str(iout)] = field
-
-                        # Append row to output list
-                out.append(outrow)
-        sortedlist = sorted(out, key=itemgetter('full_name'))
-        writer.writerows(sortedlist)
+        parent = root
+        names = row['full_name'].split(':')
+        for depth in range(len(names)):
+            fullname = ':'.join(names[:depth + 1])
+            account = accounts.get(fullname)
+            if account is None:
+                account = Account(book)
+                account.SetName(names[depth])
+                account.SetType(atype)
+                account.SetCommodity(commodities[key])
+                if depth == len(names) - 1:
+                    account.SetDescription(row.get('description') or '')
+                    account.SetHidden(row['hidden'] == 'T')
+                    account.SetPlaceholder(row['place_holder'] == 'T')
+                else:
+                    account.SetPlaceholder(True)
+                parent.append_child(account)
+                accounts[fullname] = account
+                created += 1
+            parent = account
+    return created
 
 
 if __name__ == '__main__':
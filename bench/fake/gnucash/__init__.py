@@ -0,0 +1,200 @@
+"""Stand-in for the GnuCash python bindings, for benchmarks.
+
+It models just enough of a book for the conversion scripts to run and
+counts every binding call in calls, so a run measures the scripts' own
+work and shows how much they ask of GnuCash. Books are kept in memory,
+keyed by path, for the life of the process; nothing is read from or
+written to the .gnucash file.
+"""
+from collections import Counter
+
+calls = Counter()
+books = {}
+
+
+class Recorder(object):
+    """Accept and count any binding method that is not modelled."""
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        key = type(self).__name__ + '.' + name
+
+        def method(*args, **kwargs):
+            calls[key] += 1
+        return method
+
+
+class GncNumeric(object):
+    def __init__(self, num=0, denom=1):
+        calls['GncNumeric'] += 1
+        self._num = num
+        self._denom = denom
+
+    def num(self):
+        return self._num
+
+    def denom(self):
+        return self._denom
+
+    def neg(self):
+        return GncNumeric(-self._num, self._denom)
+
+    def to_string(self):
+        return '%d/%d' % (self._num, self._denom)
+
+    def __str__(self):
+        return self.to_string()
+
+
+class Commodity(Recorder):
+    def __init__(self, namespace, mnemonic):
+        self.namespace = namespace
+        self.mnemonic = mnemonic
+
+    def get_mnemonic(self):
+        return self.mnemonic
+
+
+class CommodityTable(Recorder):
+    def __init__(self):
+        self.commodities = {}
+
+    def lookup(self, namespace, mnemonic):
+        calls['CommodityTable.lookup'] += 1
+        key = (namespace, mnemonic)
+        if key not in self.commodities:
+            self.commodities[key] = Commodity(namespace, mnemonic)
+        return self.commodities[key]
+
+
+class Account(Recorder):
+    def __init__(self, book=None):
+        calls['Account'] += 1
+        self.name = ''
+        self.type = None
+        self.parent = None
+        self.children = []
+
+    def SetName(self, name):
+        calls['Account.SetName'] += 1
+        self.name = name
+
+    def GetName(self):
+        calls['Account.GetName'] += 1
+        return self.name
+
+    def SetType(self, atype):
+        calls['Account.SetType'] += 1
+        self.type = atype
+
+    def GetType(self):
+        return self.type
+
+    def append_child(self, child):
+        calls['Account.append_child'] += 1
+        if child.parent is not None:
+            child.parent.children.remove(child)
+        child.parent = self
+        self.children.append(child)
+
+    def get_parent(self):
+        return self.parent
+
+    def get_children(self):
+        calls['Account.get_children'] += 1
+        return list(self.children)
+
+    def get_full_name(self):
+        calls['Account.get_full_name'] += 1
+        names = []
+        account = self
+        while account.parent is not None:
+            names.append(account.name)
+            account = account.parent
+        return ':'.join(reversed(names))
+
+    def lookup_by_name(self, name):
+        # Children first, then each child's subtree, like GnuCash
+        calls['Account.lookup_by_name'] += 1
+        for child in self.children:
+            if child.name == name:
+                return child
+        for child in self.children:
+            found = child.lookup_by_name(name)
+            if found is not None:
+                return found
+        return None
+
+
+class Book(Recorder):
+    def __init__(self):
+        self.root = Account(self)
+        self.table = CommodityTable()
+        self.owners = {'gncCustomer': [], 'gncVendor': []}
+        self.taxtables = {}
+        self.counters = Counter()
+
+    def get_root_account(self):
+        return self.root
+
+    def get_table(self):
+        return self.table
+
+    def TaxTableLookupByName(self, name):
+        calls['Book.TaxTableLookupByName'] += 1
+        return self.taxtables.get(name)
+
+    def _lookup_id(self, search_type, cid):
+        for owner in self.owners[search_type]:
+            if owner.GetID() == cid:
+                return owner
+        return None
+
+    def CustomerLookupByID(self, cid):
+        calls['Book.CustomerLookupByID'] += 1
+        return self._lookup_id('gncCustomer', cid)
+
+    def VendorLookupByID(self, cid):
+        calls['Book.VendorLookupByID'] += 1
+        return self._lookup_id('gncVendor', cid)
+
+    def _next_id(self, counter):
+        calls['Book.' + counter + 'NextID'] += 1
+        self.counters[counter] += 1
+        return '%06d' % self.counters[counter]
+
+    def CustomerNextID(self):
+        return self._next_id('Customer')
+
+    def VendorNextID(self):
+        return self._next_id('Vendor')
+
+    def InvoiceNextID(self, owner):
+        return self._next_id('Invoice')
+
+    def BillNextID(self, owner):
+        return self._next_id('Bill')
+
+
+class Session(Recorder):
+    def __init__(self, path=None, is_new=False, *args, **kwargs):
+        calls['Session'] += 1
+        if is_new or path not in books:
+            books[path] = Book()
+        self.book = books[path]
+
+
+class Query(Recorder):
+    def search_for(self, search_type):
+        self.search_type = search_type
+
+    def set_book(self, book):
+        self.book = book
+
+    def run(self):
+        calls['Query.run'] += 1
+        return list(self.book.owners[self.search_type])
+
+    def destroy(self):
+        pass
@@ -0,0 +1,148 @@
+"""Business objects of the GnuCash bindings stand-in."""
+from gnucash import Recorder, calls
+
+
+class Owner(Recorder):
+    search_type = ''
+
+    def __init__(self, book=None, cid='', currency=None, name='',
+                 instance=None):
+        calls[type(self).__name__] += 1
+        if instance is not None:
+            # Wrap the same owner, as the bindings do
+            self.__dict__ = instance.__dict__
+            return
+        self.cid = cid
+        self.name = name
+        self.notes = ''
+        self.taxtable = None
+        self.override = False
+        self.addr = Address()
+        self.shipaddr = Address()
+        book.owners[self.search_type].append(self)
+
+    def GetID(self):
+        return self.cid
+
+    def SetID(self, cid):
+        calls[type(self).__name__ + '.SetID'] += 1
+        self.cid = cid
+
+    def GetName(self):
+        return self.name
+
+    def SetName(self, name):
+        calls[type(self).__name__ + '.SetName'] += 1
+        self.name = name
+
+    SetCompany = SetName
+
+    def GetAddr(self):
+        return self.addr
+
+    def GetShipAddr(self):
+        return self.shipaddr
+
+    def GetNotes(self):
+        return self.notes
+
+    def SetNotes(self, notes):
+        calls[type(self).__name__ + '.SetNotes'] += 1
+        self.notes = notes
+
+    def GetTaxTable(self):
+        return self.taxtable
+
+    def SetTaxTable(self, taxtable):
+        calls[type(self).__name__ + '.SetTaxTable'] += 1
+        self.taxtable = taxtable
+
+    def GetTaxTableOverride(self):
+        return self.override
+
+    def SetTaxTableOverride(self, override):
+        calls[type(self).__name__ + '.SetTaxTableOverride'] += 1
+        self.override = override
+
+
+class Customer(Owner):
+    search_type = 'gncCustomer'
+
+
+class Vendor(Owner):
+    search_type = 'gncVendor'
+
+
+class Address(Recorder):
+    # Keeps what each SetX stores for the matching GetX
+    def __init__(self):
+        self.fields = {}
+
+    def __getattr__(self, name):
+        if name.startswith('Get'):
+            return lambda: self.fields.get(name[3:], '')
+        if name.startswith('Set'):
+            def method(value):
+                calls['Address.' + name] += 1
+                self.fields[name[3:]] = value
+            return method
+        return Recorder.__getattr__(self, name)
+
+
+class Invoice(Recorder):
+    def __init__(self, book=None, cid='', currency=None, owner=None):
+        calls[type(self).__name__] += 1
+        self.owner = owner
+
+    def GetOwner(self):
+        return self.owner
+
+
+class Bill(Invoice):
+    pass
+
+
+class Entry(Recorder):
+    def __init__(self, book=None, invoice=None):
+        calls['Entry'] += 1
+
+
+class Transaction(Recorder):
+    def __init__(self, book=None):
+        calls['Transaction'] += 1
+
+
+class Split(Recorder):
+    def __init__(self, book=None):
+        calls['Split'] += 1
+
+
+class TaxTableEntry(Recorder):
+    def __init__(self, account=None, percent=True, amount=None):
+        calls['TaxTableEntry'] += 1
+        self.account = account
+        self.amount = amount
+
+    def GetAccount(self):
+        return self.account
+
+    def GetAmount(self):
+        return self.amount
+
+    def SetAmount(self, amount):
+        calls['TaxTableEntry.SetAmount'] += 1
+        self.amount = amount
+
+
+class TaxTable(Recorder):
+    def __init__(self, book=None, name='', entry=None):
+        calls['TaxTable'] += 1
+        self.name = name
+        self.entries = [entry]
+        book.taxtables[name] = self
+
+    def GetName(self):
+        return self.name
+
+    def GetEntries(self):
+        return list(self.entries)
@@ -0,0 +1,17 @@
+"""Account type constants, numbered as in GnuCash."""
+ACCT_TYPE_NONE = -1
+ACCT_TYPE_BANK = 0
+ACCT_TYPE_CASH = 1
+ACCT_TYPE_ASSET = 2
+ACCT_TYPE_CREDIT = 3
+ACCT_TYPE_LIABILITY = 4
+ACCT_TYPE_STOCK = 5
+ACCT_TYPE_MUTUAL = 6
+ACCT_TYPE_CURRENCY = 7
+ACCT_TYPE_INCOME = 8
+ACCT_TYPE_EXPENSE = 9
+ACCT_TYPE_EQUITY = 10
+ACCT_TYPE_RECEIVABLE = 11
+ACCT_TYPE_PAYABLE = 12
+ACCT_TYPE_ROOT = 13
+ACCT_TYPE_TRADING = 14
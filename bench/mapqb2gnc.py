@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# Micro-benchmark for tax.mapqb2gnc on a synthetic QuickBooks transaction
+# export. Compares the precompiled mapping plan with the old per-key
+# DictReader mapping. Uses the gnucash stand-in in bench/fake unless the
+# real bindings are installed.
+import argparse
+import csv
+import os
+import sys
+import time
+from StringIO import StringIO
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+sys.path.append(os.path.join(BENCH, 'fake'))
+import tax
+
+
+def synthetic_export(rows):
+    # Invoice documents of a header, two detail rows and a total row
+    out = StringIO()
+    writer = csv.writer(out, dialect='excel')
+    writer.writerow(tax.transmap.keys())
+    fields = tax.transmap.keys()
+    document = [
+        {'Type': 'Invoice', 'Date': '01/02/2015', 'Num': '1001',
+         'Name': 'Customer 1', 'Memo': 'Invoice memo', 'Paid': 'Paid',
+         'Account': 'Accounts Receivable', 'Split': '-SPLIT-',
+         'Amount': '108.30'},
+        {'Item': 'Widget', 'Item Description': 'A widget',
+         'Account': 'Sales', 'Sales Tax Code': 'Tax', 'Qty': '-2',
+         'Sales Price': '50.00', 'Amount': '-100.00'},
+        {'Item': 'WA Sales Tax', 'Account': 'Sales Tax Payable',
+         'Sales Price': '8.3%', 'Amount': '-8.30'},
+        {'Amount': '108.30'}]
+    for i in xrange(rows):
+        row = document[i % len(document)]
+        writer.writerow([row.get(field, '') for field in fields])
+    return out.getvalue()
+
+
+def legacy_mapqb2gnc(reader, usemap):
+    # tax.mapqb2gnc before the mapping plan, kept for comparison
+    commakey = ()
+    spacekey = ('notes')
+    linekey = ()
+    out = []
+    for row in reader:
+        outrow = {}
+        for field in usemap:
+            test = row[str(field)]
+            if usemap[str(field)] == 'not mapped' or \
+                    not test:
+                continue
+            elif str((usemap[str(field)])) in outrow:
+                if usemap[str(field)] in commakey:
+                    outrow[usemap[str(field)]] += ', ' + \
+                                                  row[str(field)]
+                elif usemap[str(field)] in spacekey:
+                    outrow[usemap[str(field)]] += ' ' + row[str(field)]
+                elif usemap[str(field)] in linekey:
+                    outrow[usemap[str(field)]] += '\n' + field + \
+                                                  ': ' + row[str(field)]
+            else:
+                outrow[usemap[str(field)]] = row[str(field)]
+        out.append(outrow)
+    return out
+
+
+def timed(label, rows, func):
+    start = time.time()
+    count = func()
+    elapsed = time.time() - start
+    print '%-10s %8d rows %7.2f s %10.0f rows/s' % (
+        label, count, elapsed, rows / elapsed)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mapqb2gnc')
+    parser.add_argument('--rows', type=int, default=500000,
+                        help='Synthetic transaction rows to map')
+    args = parser.parse_args()
+
+    data = synthetic_export(args.rows)
+
+    before = timed('before', args.rows, lambda: len(legacy_mapqb2gnc(
+        csv.DictReader(StringIO(data)), tax.transmap)))
+    after = timed('after', args.rows, lambda: sum(1 for _ in tax.mapqb2gnc(
+        csv.reader(StringIO(data)), tax.transmap)))
+    print 'speedup    %.2fx' % (before / after)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# Benchmark account.py, numstrip.py and each tax.py mode on synthetic
+# QuickBooks exports, against the gnucash stand-in in bench/fake unless
+# --real is given. Each stage runs in its own process so peak RSS is per
+# stage. Results are appended to a history file keyed by git commit, and
+# --compare flags stages that got slower than the previous commit's run.
+# Timings only compare on one machine, so the default history file is
+# kept out of git.
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH)
+FAKE = os.path.join(BENCH, 'fake')
+
+STAGES = ('numstrip', 'account', 'account-book', 'tax-items',
+          'tax-customer', 'tax-vendor', 'tax-map', 'tax-parse',
+          'tax-transactions', 'tax-plan', 'replace-tree', 'replace-stream')
+
+
+def setup_book(tax, path):
+    # Give the book what the synthetic transactions post against
+    import synth
+    from qbutil import numeric_parts
+    from gnucash import Account, GncNumeric
+    from gnucash.gnucash_business import (Customer, Vendor, TaxTable,
+                                          TaxTableEntry)
+
+    open(path, 'a').close()
+    if os.path.exists(path + '.posted'):
+        # Post everything again, as on the first run
+        os.remove(path + '.posted')
+    tax.GncFile.gnc_open(path)
+    book = tax.GncFile.book
+    for fullname in synth.LEDGER_ACCOUNTS:
+        parent = book.get_root_account()
+        for name in fullname.split(':'):
+            child = parent.lookup_by_name(name)
+            if child is None:
+                child = Account(book)
+                child.SetName(name)
+                parent.append_child(child)
+            parent = child
+    payable = book.get_root_account().lookup_by_name('Sales Tax Payable')
+    for name, rate in zip(synth.TAX_ITEMS, synth.TAX_RATES):
+        TaxTable(book, name, TaxTableEntry(
+            payable, True, GncNumeric(*numeric_parts(rate))))
+    for i in xrange(max(1, count_rows(os.path.join(
+            os.path.dirname(path), 'customer.csv')))):
+        Customer(book, 'C%05d' % i, tax.GncFile.USD, synth.customer_name(i))
+        Vendor(book, 'V%05d' % i, tax.GncFile.USD, synth.vendor_name(i))
+    tax.GncFile.gnc_end()
+
+
+def setup_snapshot(tax, path, owners):
+    # What setup_book puts in the book, as a --plan snapshot
+    import synth
+    from qbutil import numeric_parts
+
+    accounts = set()
+    for fullname in synth.LEDGER_ACCOUNTS:
+        names = fullname.split(':')
+        accounts.update(':'.join(names[:i + 1]) for i in range(len(names)))
+    tax.Snapshot(
+        dict((synth.customer_name(i), 'C%05d' % i) for i in xrange(owners)),
+        dict((synth.vendor_name(i), 'V%05d' % i) for i in xrange(owners)),
+        sorted(accounts),
+        dict((name, numeric_parts(rate))
+             for name, rate in zip(synth.TAX_ITEMS, synth.TAX_RATES))
+    ).save(path)
+
+
+def count_rows(path):
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def run_stage(stage, data):
+    # Runs in the child process; returns the number of rows processed
+    def path(name):
+        return os.path.join(data, name)
+
+    out = tempfile.mktemp(suffix='.csv', dir=data)
+    if stage == 'numstrip':
+        import numstrip
+        sys.argv = ['numstrip.py', path('ledger.csv'), out]
+        numstrip.main()
+        return count_rows(path('ledger.csv'))
+    if stage == 'account':
+        import account
+        sys.argv = ['account.py', path('accounts.csv'), out]
+        account.main()
+        return count_rows(path('accounts.csv'))
+    if stage == 'account-book':
+        import account
+        book = path('accounts.gnucash')
+        open(book, 'a').close()
+        sys.argv = ['account.py', '--gnucash', path('accounts.csv'), book]
+        account.main()
+        return count_rows(path('accounts.csv'))
+
+    import csv
+    import tax
+    book = path('bench.gnucash')
+    if stage in ('tax-items', 'tax-customer', 'tax-vendor',
+                 'tax-transactions'):
+        setup_book(tax, book)
+        option, name = {'tax-items': ('--items', 'items.csv'),
+                        'tax-customer': ('--customer', 'customer.csv'),
+                        'tax-vendor': ('--vendor', 'vendor.csv'),
+                        'tax-transactions': ('--transactions',
+                                             'transactions.csv')}[stage]
+        sys.argv = ['tax.py', option, path(name), book]
+        tax.main()
+        return count_rows(path(name))
+    if stage == 'tax-plan':
+        snapshot = path('snapshot.json')
+        setup_snapshot(tax, snapshot,
+                       max(1, count_rows(path('customer.csv'))))
+        open(book, 'a').close()
+        os.utime(snapshot, None)
+        if os.path.exists(book + '.posted'):
+            os.remove(book + '.posted')
+        sys.argv = ['tax.py', '--plan', '--snapshot', snapshot,
+                    '--transactions', path('transactions.csv'), book]
+        tax.main()
+        return count_rows(path('transactions.csv'))
+    if stage == 'tax-map':
+        for _ in tax.mapqb2gnc(csv.reader(open(path('transactions.csv'))),
+                               tax.transmap):
+            pass
+        return count_rows(path('transactions.csv'))
+    if stage == 'tax-parse':
+        for _ in tax.parse_documents(tax.mapqb2gnc(
+                csv.reader(open(path('transactions.csv'))), tax.transmap)):
+            pass
+        return count_rows(path('transactions.csv'))
+    if stage in ('replace-tree', 'replace-stream'):
+        from gnucash import GncNumeric
+        xml = path('replace.xml')
+        shutil.copy(path('book.xml'), xml)
+        lines = count_rows(path('book.xml'))
+        tax.GncFile.gnc_open(xml)
+        for cid in xrange(1, 1000, 7):
+            tax.ReplaceTax.invoice('%06d' % cid, GncNumeric(900000, 100000))
+        tax.ReplaceTax.replace(xml, stream=stage == 'replace-stream')
+        tax.GncFile.gnc_end()
+        # Rows of a book are its XML lines
+        return lines
+    raise ValueError(stage)
+
+
+def child(stage, data, real):
+    sys.path.insert(0, REPO)
+    sys.path.insert(0, BENCH)
+    if not real:
+        sys.path.insert(0, FAKE)
+    # Keep the scripts' own output off the result line
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    start = time.time()
+    rows = run_stage(stage, data)
+    seconds = time.time() - start
+    sys.stdout = stdout
+    result = {'stage': stage, 'rows': rows, 'seconds': seconds,
+              'rows_per_sec': rows / seconds if seconds else 0.0,
+              'maxrss_kb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss}
+    if not real:
+        import gnucash
+        result['binding_calls'] = sum(gnucash.calls.values())
+    print json.dumps(result)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(previous, current, threshold):
+    # Return the stages whose throughput dropped by more than threshold %
+    regressions = []
+    for stage, result in sorted(current['stages'].items()):
+        before = previous['stages'].get(stage)
+        if not before or not before['rows_per_sec']:
+            continue
+        change = 100.0 * (result['rows_per_sec'] / before['rows_per_sec']
+                          - 1)
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(stage)
+        print '%-18s %10.0f -> %10.0f rows/s %+7.1f%%%s' % (
+            stage, before['rows_per_sec'], result['rows_per_sec'], change,
+            flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the QuickBooks conversion scripts')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Approximate transaction and ledger rows')
+    parser.add_argument('--data', help='Directory for the synthetic inputs '
+                                       '(default: a temporary directory)')
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help='Run only this stage; may be repeated')
+    parser.add_argument('--real', action='store_true',
+                        help='Use the installed gnucash bindings')
+    parser.add_argument('--history',
+                        default=os.path.join(BENCH, 'history.jsonl'),
+                        help='Results file, one JSON run per line')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare with the last run of another commit '
+                             'and exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Slowdown in percent counted as a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.data, args.real)
+
+    import synth
+    data = args.data or tempfile.mkdtemp(prefix='qb2gnc-bench-')
+    start = time.time()
+    synth.generate(data, args.rows)
+    print 'synthetic inputs: %s (%.1f s)' % (data, time.time() - start)
+
+    run = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'rows': args.rows, 'real': args.real, 'stages': {}}
+    print '%-18s %9s %9s %12s %10s' % ('stage', 'rows', 'seconds', 'rows/s',
+                                      'peak RSS')
+    for stage in args.stage or STAGES:
+        command = [sys.executable, os.path.abspath(__file__), '--child',
+                   stage, '--data', data]
+        if args.real:
+            command.append('--real')
+        output = subprocess.check_output(command)
+        result = json.loads(output.splitlines()[-1])
+        run['stages'][stage] = result
+        print '%-18s %9d %9.2f %12.0f %8d MB' % (
+            stage, result['rows'], result['seconds'], result['rows_per_sec'],
+            result['maxrss_kb'] // 1024)
+
+    if not args.data:
+        shutil.rmtree(data)
+
+    history = load_history(args.history)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+
+    if args.compare:
+        previous = [old for old in history
+                    if old['commit'] != run['commit'] and
+                    old['rows'] == run['rows'] and
+                    old.get('real') == run['real']]
+        if not previous:
+            print 'No earlier run of another commit to compare with'
+            return 0
+        print 'compared with %s (%s)' % (previous[-1]['commit'],
+                                         previous[-1]['date'])
+        if compare(previous[-1], run, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
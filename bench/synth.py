@@ -0,0 +1,281 @@
+#!/usr/bin/python
+# Synthetic QuickBooks exports and GnuCash XML books for the benchmarks.
+# Every generator is deterministic for a given size.
+import argparse
+import csv
+import os
+import sys
+
+CUSTOMER_FIELDS = (
+    'Active Status', 'Customer', 'Balance', 'Balance Total', 'Company',
+    'Mr./Ms./...', 'First Name', 'M.I.', 'Last Name', 'Contact', 'Phone',
+    'Fax', 'Alt. Phone', 'Alt. Contact', 'Email', 'Bill to 1', 'Bill to 2',
+    'Bill to 3', 'Bill to 4', 'Bill to 5', 'Ship to 1', 'Ship to 2',
+    'Ship to 3', 'Ship to 4', 'Ship to 5', 'Customer Type', 'Terms', 'Rep',
+    'Sales Tax Code', 'Tax item', 'Resale Num', 'Account No.',
+    'Credit Limit', 'Job Status', 'Job Type', 'Job Description',
+    'Start Date', 'Projected End', 'End Date', 'Note')
+
+VENDOR_FIELDS = (
+    'Active Status', 'Vendor', 'Balance', 'Balance Total', 'Company',
+    'Mr./Ms./...', 'First Name', 'M.I.', 'Last Name', 'Bill from 1',
+    'Bill from 2', 'Bill from 3', 'Bill from 4', 'Bill from 5',
+    'Ship from 1', 'Ship from 2', 'Ship from 3', 'Ship from 4',
+    'Ship from 5', 'Contact', 'Phone', 'Fax', 'Alt. Phone', 'Alt. Contact',
+    'Email')
+
+ITEM_FIELDS = (
+    'Active Status', 'Type', 'Item', 'Description', 'Sales Tax Code',
+    'Account', 'COGS Account', 'Asset Account', 'Accumulated Depreciation',
+    'Purchase Description', 'Quantity On Hand', 'Cost', 'Preferred Vendor',
+    'Tax Agency', 'Price', 'Reorder Point', 'MPN')
+
+ACCOUNT_FIELDS = ('Active Status', 'Account', 'Type', 'Balance Total',
+                  'Description', 'Tax Line')
+
+TRANSACTION_FIELDS = (
+    'Type', 'Date', 'Num', 'Name', 'Memo', 'Paid', 'Item',
+    'Item Description', 'Account', 'Sales Tax Code', 'Qty', 'Sales Price',
+    'Split', 'Amount')
+
+LEDGER_FIELDS = ('Type', 'Date', 'Num', 'Name', 'Memo', 'Account',
+                 'COGS Account', 'Split', 'Amount')
+
+ACCOUNT_TYPES = ('Bank', 'Accounts Receivable', 'Other Current Asset',
+                 'Fixed Asset', 'Accounts Payable', 'Credit Card',
+                 'Other Current Liability', 'Equity', 'Income',
+                 'Cost of Goods Sold', 'Expense', 'Other Income',
+                 'Other Expense')
+
+# Accounts the synthetic transactions post to, by full GnuCash name
+LEDGER_ACCOUNTS = ('Assets:Accounts Receivable', 'Assets:Checking',
+                   'Liabilities:Accounts Payable',
+                   'Liabilities:Sales Tax Payable', 'Income:Sales',
+                   'Expenses:Supplies')
+
+TAX_ITEMS = ('WA Sales Tax', 'OR Sales Tax', 'ID Sales Tax')
+TAX_RATES = ('8.3%', '0%', '6%')
+
+
+def customer_name(i):
+    return 'Customer %05d' % i
+
+
+def vendor_name(i):
+    return 'Vendor %05d' % i
+
+
+def write_csv(path, fieldnames, rows):
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, dialect='excel')
+        writer.writeheader()
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def customers(n):
+    for i in xrange(n):
+        yield {'Active Status': 'Active', 'Customer': customer_name(i),
+               'Contact': 'Contact %d' % i, 'Phone': '509-555-%04d' % i,
+               'Alt. Contact': 'Alt %d' % i, 'Email': 'c%d@example.com' % i,
+               'Bill to 1': customer_name(i),
+               'Bill to 2': '%d Broadway' % i, 'Bill to 3': 'Kennewick, WA',
+               'Ship to 1': customer_name(i), 'Ship to 2': '%d Main' % i,
+               'Sales Tax Code': 'Tax', 'Tax item': TAX_ITEMS[i % 3],
+               'Account No.': 'C%05d' % i, 'Note': 'Note %d' % i}
+
+
+def vendors(n):
+    for i in xrange(n):
+        yield {'Active Status': 'Active', 'Vendor': vendor_name(i),
+               'Bill from 1': vendor_name(i), 'Bill from 2': '%d Elm' % i,
+               'Bill from 3': 'Pasco, WA', 'Contact': 'Contact %d' % i,
+               'Phone': '509-555-%04d' % i, 'Alt. Phone': '509-555-0000',
+               'Email': 'v%d@example.com' % i}
+
+
+def items(n):
+    for i in xrange(n):
+        if i < len(TAX_ITEMS):
+            yield {'Active Status': 'Active', 'Type': 'Sales Tax Item',
+                   'Item': TAX_ITEMS[i], 'Account': 'Sales Tax Payable',
+                   'Price': TAX_RATES[i]}
+        else:
+            yield {'Active Status': 'Active', 'Type': 'Service',
+                   'Item': 'Item %05d' % i, 'Account': 'Sales',
+                   'Price': '%d.00' % (i % 200)}
+
+
+def accounts(n):
+    # A chart of accounts n deep in subaccounts, numbered the QuickBooks way
+    for i in xrange(n):
+        atype = ACCOUNT_TYPES[i // 10 % len(ACCOUNT_TYPES)]
+        parent = '%d %s %d' % (1000 + i // 10 * 10, atype, i // 10)
+        if i % 10:
+            name = '%s:%d Account %d' % (parent, 1000 + i, i)
+        else:
+            name = parent
+        yield {'Active Status': 'Active' if i % 7 else 'Inactive',
+               'Account': name, 'Type': atype, 'Balance Total': '0.00',
+               'Description': 'Account %d' % i, 'Tax Line': ''}
+
+
+def transactions(n, owners=1000):
+    # n documents: invoices, bills, payments, bill payments and journals
+    for i in xrange(n):
+        date = '%02d/%02d/2015' % (i % 12 + 1, i % 28 + 1)
+        kind = i % 5
+        if kind == 0:
+            tax = i % 3
+            yield {'Type': 'Invoice', 'Date': date, 'Num': str(i),
+                   'Name': customer_name(i % owners), 'Memo': 'Invoice',
+                   'Paid': 'Paid', 'Account': 'Accounts Receivable',
+                   'Split': '-SPLIT-', 'Amount': '108.30'}
+            yield {'Item': 'Item %05d' % (i % 50), 'Account': 'Sales',
+                   'Item Description': 'Widget', 'Sales Tax Code': 'Tax',
+                   'Qty': '-2', 'Sales Price': '50.00', 'Amount': '-100.00'}
+            yield {'Item': TAX_ITEMS[tax], 'Account': 'Sales Tax Payable',
+                   'Sales Price': TAX_RATES[tax], 'Amount': '-8.30'}
+            yield {'Amount': '108.30'}
+        elif kind == 1:
+            yield {'Type': 'Bill', 'Date': date, 'Num': str(i),
+                   'Name': vendor_name(i % owners), 'Memo': 'Bill',
+                   'Account': 'Accounts Payable', 'Split': 'Supplies',
+                   'Amount': '-25.00'}
+            yield {'Item': 'Item %05d' % (i % 50), 'Account': 'Supplies',
+                   'Item Description': 'Paper', 'Qty': '5',
+                   'Sales Price': '5.00', 'Amount': '25.00'}
+            yield {'Amount': '-25.00'}
+        elif kind == 2:
+            yield {'Type': 'Payment', 'Date': date, 'Num': str(i),
+                   'Name': customer_name(i % owners), 'Account': 'Checking',
+                   'Split': 'Accounts Receivable', 'Amount': '108.30'}
+            yield {'Account': 'Accounts Receivable', 'Amount': '-108.30'}
+            yield {'Amount': '108.30'}
+        elif kind == 3:
+            yield {'Type': 'Bill Pmt -CCard', 'Date': date, 'Num': str(i),
+                   'Name': vendor_name(i % owners), 'Account': 'Checking',
+                   'Split': 'Accounts Payable', 'Amount': '-25.00'}
+            yield {'Account': 'Accounts Payable', 'Amount': '25.00'}
+            yield {'Amount': '-25.00'}
+        else:
+            yield {'Type': 'General Journal', 'Date': date, 'Num': str(i),
+                   'Memo': 'Journal %d' % i, 'Account': 'Checking',
+                   'Split': 'Supplies', 'Amount': '-10.00'}
+            yield {'Account': 'Supplies', 'Amount': '10.00'}
+            yield {'Amount': '0.00'}
+
+
+def ledger(n):
+    # General ledger rows with QuickBooks account numbers left in
+    for i in xrange(n):
+        account = '%d Expense %d:%d Account %d' % (
+            6000 + i % 40, i % 40, 6100 + i % 400, i % 400)
+        yield {'Type': 'Check', 'Date': '%02d/01/2015' % (i % 12 + 1),
+               'Num': str(i), 'Name': vendor_name(i % 1000),
+               'Memo': 'Check %d for 1000 Checking' % i, 'Account': account,
+               'COGS Account': '5000 Cost of Goods Sold' if i % 4 else '',
+               'Split': '-SPLIT-' if i % 3 == 0 else '1000 Checking',
+               'Amount': '%d.%02d' % (i % 1000, i % 100)}
+
+
+BOOK_HEAD = '''<?xml version="1.0" encoding="utf-8" ?>
+<gnc-v2
+     xmlns:gnc="http://www.gnucash.org/XML/gnc"
+     xmlns:book="http://www.gnucash.org/XML/book"
+     xmlns:cd="http://www.gnucash.org/XML/cd"
+     xmlns:entry="http://www.gnucash.org/XML/entry"
+     xmlns:invoice="http://www.gnucash.org/XML/invoice"
+     xmlns:taxtable="http://www.gnucash.org/XML/taxtable"
+     xmlns:tte="http://www.gnucash.org/XML/tte">
+<gnc:count-data cd:type="book">1</gnc:count-data>
+<gnc:book version="2.0.0">
+<book:id type="guid">0000000000000000000000000000b00k</book:id>
+'''
+
+BOOK_ENTRY = '''<gnc:GncEntry version="2.0.0">
+  <entry:guid type="guid">%(guid)032x</entry:guid>
+  <entry:invoice type="guid">%(invoice)032x</entry:invoice>
+  <entry:i-taxtable type="guid">%(taxtable)032x</entry:i-taxtable>
+</gnc:GncEntry>
+'''
+
+BOOK_INVOICE = '''<gnc:GncInvoice version="2.0.0">
+  <invoice:guid type="guid">%(invoice)032x</invoice:guid>
+  <invoice:id>%(id)06d</invoice:id>
+</gnc:GncInvoice>
+'''
+
+BOOK_TAXTABLE = '''<gnc:GncTaxTable version="2.0.0">
+  <taxtable:guid type="guid">%(taxtable)032x</taxtable:guid>
+  <taxtable:name>%(name)s</taxtable:name>
+  <taxtable:entries>
+    <gnc:GncTaxTableEntry>
+      <tte:acct type="guid">%(taxtable)032x</tte:acct>
+      <tte:amount>830000/100000</tte:amount>
+      <tte:type>PERCENT</tte:type>
+    </gnc:GncTaxTableEntry>
+  </taxtable:entries>
+</gnc:GncTaxTable>
+'''
+
+
+def book_xml(path, n):
+    # A GnuCash XML book with n invoices of one entry each, written in
+    # GnuCash's order: entries, then invoices, then tax tables
+    with open(path, 'wb') as f:
+        f.write(BOOK_HEAD)
+        for i in xrange(n):
+            f.write(BOOK_ENTRY % {'guid': 2 * n + i, 'invoice': n + i,
+                                  'taxtable': i % len(TAX_ITEMS) + 1})
+        for i in xrange(n):
+            f.write(BOOK_INVOICE % {'invoice': n + i, 'id': i + 1})
+        for i, name in enumerate(TAX_ITEMS):
+            f.write(BOOK_TAXTABLE % {'taxtable': i + 1, 'name': name})
+        f.write('</gnc:book>\n</gnc-v2>\n')
+    return n
+
+
+def generate(directory, rows):
+    # Write every synthetic input into directory; return row counts
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def path(name):
+        return os.path.join(directory, name)
+
+    owners = max(1, rows // 20)
+    return {
+        'customer.csv': write_csv(path('customer.csv'), CUSTOMER_FIELDS,
+                                  customers(owners)),
+        'vendor.csv': write_csv(path('vendor.csv'), VENDOR_FIELDS,
+                                vendors(owners)),
+        'items.csv': write_csv(path('items.csv'), ITEM_FIELDS,
+                               items(max(len(TAX_ITEMS), rows // 100))),
+        'accounts.csv': write_csv(path('accounts.csv'), ACCOUNT_FIELDS,
+                                  accounts(max(10, rows // 10))),
+        'transactions.csv': write_csv(path('transactions.csv'),
+                                      TRANSACTION_FIELDS,
+                                      transactions(rows // 3, owners)),
+        'ledger.csv': write_csv(path('ledger.csv'), LEDGER_FIELDS,
+                                ledger(rows)),
+        'book.xml': book_xml(path('book.xml'), max(1, rows // 10)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write synthetic QuickBooks exports for benchmarks')
+    parser.add_argument('directory', help='Output directory')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Approximate transaction and ledger rows')
+    args = parser.parse_args()
+    for name, count in sorted(generate(args.directory, args.rows).items()):
+        print '%-18s %8d rows' % (name, count)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# Run the whole QuickBooks to GnuCash migration in one process:
+# numstrip -> account -> tax. Account numbers are stripped as each csv is
+# read, the chart of accounts is built straight into the book, and items,
+# customers, vendors and transactions are imported in the same session.
+import argparse
+import csv
+import sys
+import time
+
+import account
+import numstrip
+import qbutil
+import tax
+from tax import GncFile
+
+
+def read(path):
+    # csv rows of a QuickBooks export with account numbers removed
+    return numstrip.stripped(csv.reader(open(path, 'rb'), dialect='excel'))
+
+
+def read_dicts(path):
+    rows = read(path)
+    fieldnames = next(rows)
+    for row in rows:
+        yield dict(zip(fieldnames, row))
+
+
+class Stages(object):
+    # Wall-clock time and row counts of each migration stage
+    def __init__(self):
+        self.timings = []
+
+    def run(self, name, func, *args):
+        start = time.time()
+        count = func(*args)
+        self.timings.append((name, count, time.time() - start))
+
+    def report(self):
+        print '%-14s %9s %9s' % ('stage', 'rows', 'seconds')
+        for name, count, seconds in self.timings:
+            print '%-14s %9s %9.2f' % (name, '' if count is None else count,
+                                       seconds)
+        print '%-14s %9s %9.2f' % ('total', '',
+                                   sum(t[2] for t in self.timings))
+
+
+def import_accounts(book, path):
+    return account.add_accounts(book, account.gnc_accounts(read_dicts(path)))
+
+
+def import_rows(func, path, usemap):
+    count = 0
+    for row in tax.mapqb2gnc(read(path), usemap):
+        func(row)
+        count += 1
+    return count
+
+
+def import_owners(owners, new_owner, path, usemap, book, USD):
+    counts = owners.bulk(book, tax.mapqb2gnc(read(path), usemap), new_owner,
+                         USD)
+    return sum(counts.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Migrate QuickBooks exports into a gnucash book in '
+                    'one pass')
+    parser.add_argument('outfile', metavar='file.gnucash', nargs=1,
+                        help='gnucash file to migrate into')
+    parser.add_argument('--test',
+                        action='store_false',
+                        help='Process the input but do not update the gnucash')
+    parser.add_argument('-a', '--accounts', metavar='accounts.csv',
+                        help='QuickBooks account list')
+    parser.add_argument('-i', '--items', metavar='tax_items.csv',
+                        help='QuickBooks item list')
+    parser.add_argument('-c', '--customer', metavar='customer.csv',
+                        help='QuickBooks customer list')
+    parser.add_argument('-v', '--vendor', metavar='vendor.csv',
+                        help='QuickBooks vendor list')
+    parser.add_argument('-t', '--transactions', metavar='transactions.csv',
+                        help='QuickBooks transactions: invoices, bills, '
+                             'journal, etc.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Parse transactions in this many processes')
+    parser.add_argument('--posted', metavar='file.posted',
+                        help='Record of transactions already posted, skipped '
+                             'on a re-run (default: file.gnucash.posted)')
+    parser.add_argument('--checkpoint', metavar='N', type=int, default=0,
+                        help='Save the gnucash every N transactions')
+    parser.add_argument('--checkpoint-time', metavar='SECONDS', type=float,
+                        default=0,
+                        help='Save the gnucash at most this many seconds '
+                             'apart')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the transactions after the last '
+                             'checkpoint')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Diff all customers and vendors against the '
+                             'gnucash first and apply only the changes')
+    parser.add_argument('--date-format', metavar='FORMAT', action='append',
+                        help='QuickBooks date layout for strptime, e.g. '
+                             '%%d/%%m/%%y; may be repeated '
+                             '(default: %%m/%%d/%%Y)')
+    parser.add_argument('--profile', metavar='profile.json',
+                        help='Time each posting phase and document type, '
+                             'writing a JSON report')
+    args = parser.parse_args()
+    GncFile.nosave = args.test
+    if args.profile is not None:
+        tax.Profile.enable()
+    if args.date_format:
+        qbutil.set_date_formats(args.date_format)
+
+    stages = Stages()
+    try:
+        stages.run('open', lambda: GncFile.gnc_open(args.outfile[0]) and None)
+        book = GncFile.book
+        root = GncFile.root
+        # noinspection PyPep8Naming
+        USD = GncFile.USD
+
+        if args.accounts is not None:
+            stages.run('accounts', import_accounts, book, args.accounts)
+            tax.Accounts.invalidate()
+        if args.items is not None:
+            stages.run('items', import_rows,
+                       lambda row: tax.new_tax(root, book, USD, row),
+                       args.items, tax.itemap)
+        if args.customer is not None and args.bulk:
+            stages.run('customers', import_owners, tax.GetCustomers,
+                       tax.new_customer, args.customer, tax.custmap, book, USD)
+        elif args.customer is not None:
+            stages.run('customers', import_rows,
+                       lambda row: tax.new_customer(book, row, USD),
+                       args.customer, tax.custmap)
+        if args.vendor is not None and args.bulk:
+            stages.run('vendors', import_owners, tax.GetVendors,
+                       tax.new_vendor, args.vendor, tax.vendmap, book, USD)
+        elif args.vendor is not None:
+            stages.run('vendors', import_rows,
+                       lambda row: tax.new_vendor(book, row, USD),
+                       args.vendor, tax.vendmap)
+        if args.transactions is not None:
+            stages.run('transactions', tax.import_transactions, root, book,
+                       USD, args.transactions, args, read)
+
+        stages.run('save', GncFile.gnc_save)
+        tax.end_session(args)
+
+    except:
+        tax.end_session(args, failed=True)
+        raise
+
+    stages.report()
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
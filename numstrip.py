@@ -3,7 +3,162 @@
 import sys
 import argparse
 import csv
+import multiprocessing
+import os
 import re
+from cStringIO import StringIO
+
+from qbutil import memoize
+
+# QuickBooks account numbers: '1000 ' at the start and ':1010 ' after
+# each parent account
+rem1 = re.compile(r'^\d+ ')
+rem2 = re.compile(r':\d+ ')
+
+
+def strip_number(value):
+    return rem2.sub(':', rem1.sub('', value))
+
+
+# A ledger repeats a few hundred account paths millions of times, so
+# each distinct path is cleaned once and the result interned
+@memoize(65536)
+def strip_account(value):
+    return intern(strip_number(value))
+
+
+def strip_split(value):
+    if value == '-SPLIT-':
+        return value
+    return strip_account(value)
+
+
+# Columns holding account names, and how to strip each. Memos are mostly
+# unique, so they are not cached.
+stripcolumns = {'Account': strip_account,
+                'Split': strip_split,
+                'COGS Account': strip_account,
+                'Memo': strip_number}
+
+
+def cache_report(hits, misses):
+    # Misses are not a distinct count: evicted paths miss again, and with
+    # --jobs each worker misses on its own
+    lookups = hits + misses
+    if lookups:
+        print >> sys.stderr, 'Account paths: %d, cache misses: %d, ' \
+                             'cache hit rate: %.1f%%' % (
+                                 lookups, misses, 100.0 * hits / lookups)
+
+
+def strip_columns(fieldnames):
+    # (column index, stripper) for each account column in the header
+    return [(i, stripcolumns[name]) for i, name in enumerate(fieldnames)
+            if name in stripcolumns]
+
+
+def strip_records(reader, columns, width):
+    for row in reader:
+        if not row:
+            # Blank line, dropped as the DictReader version did
+            continue
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        for i, strip in columns:
+            row[i] = strip(row[i])
+        yield row
+
+
+def stripped(reader):
+    # Yield the header of a csv.reader, then each row with account
+    # numbers removed; usable wherever a csv.reader is expected
+    fieldnames = next(reader)
+    yield fieldnames
+    for row in strip_records(reader, strip_columns(fieldnames),
+                             len(fieldnames)):
+        yield row
+
+
+def strip_rows(reader, writer):
+    # Copy rows from a csv.reader to a csv.writer, one row at a time
+    writer.writerows(stripped(reader))
+
+
+def record_end(f, offset, quotes):
+    # Return the offset just past the first record boundary at or after
+    # offset: a newline with an even number of quotes before it, so it is
+    # not inside a quoted field. quotes is the count before offset.
+    f.seek(offset)
+    while True:
+        line = f.readline()
+        if not line:
+            return offset, quotes
+        offset += len(line)
+        quotes += line.count('"')
+        if not quotes % 2:
+            return offset, quotes
+
+
+def split_chunks(path, chunksize):
+    # Byte ranges of about chunksize that start and end on record
+    # boundaries, after the header record
+    chunks = []
+    with open(path, 'rb') as f:
+        start, quotes = record_end(f, 0, 0)
+        header = start
+        size = os.fstat(f.fileno()).st_size
+        while start < size:
+            target = min(start + chunksize, size)
+            f.seek(start)
+            # Only the parity of the quotes before target matters
+            quotes += f.read(target - start).count('"')
+            end, quotes = record_end(f, target, quotes)
+            chunks.append((start, end))
+            start = end
+    return header, chunks
+
+
+def strip_chunk(task):
+    # Worker side of strip_parallel: strip one byte range of the file.
+    # Returns the csv text and this chunk's account cache hits and misses.
+    path, start, end, columns, width = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    cache = strip_account.cache
+    hits, misses = cache.hits, cache.misses
+    out = StringIO()
+    csv.writer(out, dialect='excel').writerows(strip_records(
+        csv.reader(StringIO(data), dialect='excel'), columns, width))
+    return out.getvalue(), cache.hits - hits, cache.misses - misses
+
+
+def strip_parallel(path, outfile, jobs, chunksize=8 * 1024 * 1024):
+    # Strip record-aligned byte ranges in a process pool and write the
+    # results in file order; the output matches strip_rows exactly.
+    header, chunks = split_chunks(path, chunksize)
+    with open(path, 'rb') as f:
+        fieldnames = next(csv.reader(StringIO(f.read(header)),
+                                     dialect='excel'), None)
+    if fieldnames is None:
+        return
+    csv.writer(outfile, dialect='excel').writerow(fieldnames)
+
+    columns = strip_columns(fieldnames)
+    width = len(fieldnames)
+    hits = misses = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for data, chunkhits, chunkmisses in pool.imap(strip_chunk, [
+                (path, start, end, columns, width) for start, end in chunks]):
+            outfile.write(data)
+            hits += chunkhits
+            misses += chunkmisses
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    cache_report(hits, misses)
 
 
 def main():
@@ -11,43 +166,36 @@ def main():
     parser.add_argument('infile',
                         metavar='infile.csv',
                         nargs=1,
-                        help='QuickBooks export file')
+                        help='QuickBooks export file, - for stdin')
     parser.add_argument('outfile',
                         metavar='outfile.csv',
                         nargs=1,
-                        help='Export file with leading accoun numbers removed')
+                        help='Export file with leading account numbers '
+                             'removed, - for stdout')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Strip chunks of infile in this many processes')
     args = parser.parse_args()
+    if args.jobs > 1 and args.infile[0] == '-':
+        parser.error('--jobs needs an input file, not stdin')
 
-    reader = csv.DictReader(open(args.infile[0], 'r'), dialect='excel')
-    outfieldnames = reader.fieldnames
+    if args.infile[0] == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args.infile[0], 'rb')
+    if args.outfile[0] == '-':
+        outfile = sys.stdout
+    else:
+        outfile = open(args.outfile[0], 'wb')
 
-    out = []
-    outrow = {}
-    rem1 = '^\d+ '
-    rem2 = ':\d+ '
-    for row in reader:
-        for name in outfieldnames:
-            if name == 'Account':
-                outrow[str(name)] = re.sub(rem2, ':',
-                                           re.sub(rem1, '', row[str(name)]))
-            elif name == 'Split' and row[str(name)] != '-SPLIT-':
-                outrow[str(name)] = re.sub(rem2, ':',
-                                           re.sub(rem1, '', row[str(name)]))
-            elif name == 'COGS Account':
-                outrow[str(name)] = re.sub(rem2, ':',
-                                           re.sub(rem1, '', row[str(name)]))
-            elif name == 'Memo':
-                outrow[str(name)] = re.sub(rem2, ':',
-                                           re.sub(rem1, '', row[str(name)]))
-            else:
-                outrow[str(name)] = row[str(name)]
-        out.append(dict(outrow))
-
-    writer = csv.DictWriter(open(args.outfile[0], 'w'),
-                            fieldnames=outfieldnames,
-                            dialect='excel')
-    writer.writeheader()
-    writer.writerows(out)
+    if args.jobs > 1:
+        strip_parallel(args.infile[0], outfile, args.jobs)
+    else:
+        strip_rows(csv.reader(infile, dialect='excel'),
+                   csv.writer(outfile, dialect='excel'))
+        cache_report(strip_account.cache.hits, strip_account.cache.misses)
+    outfile.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""Helpers shared by the QuickBooks conversion scripts.
+
+Nothing here imports the gnucash bindings, so these can be used and
+checked on a machine without GnuCash.
+"""
+import datetime
+import functools
+from decimal import Decimal
+
+
+class LRUCache(object):
+    """Bounded mapping that forgets the least recently used keys.
+
+    Keys are kept in two generations of maxsize // 2. A hit in the old
+    generation moves the key to the current one, and when the current
+    one is full the old one is dropped. That is LRU at generation
+    granularity, and a hit costs a single dict lookup.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.half = max(1, maxsize // 2)
+        self.current = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.old)
+
+    def __contains__(self, key):
+        return key in self.current or key in self.old
+
+    def __getitem__(self, key):
+        try:
+            value = self.current[key]
+        except KeyError:
+            try:
+                value = self.old.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.current:
+            self.old.pop(key, None)
+            if len(self.current) >= self.half:
+                self.old = self.current
+                self.current = {}
+        self.current[key] = value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return 100.0 * self.hits / lookups
+
+
+def memoize(maxsize=4096):
+    """Cache a function's results by its positional arguments.
+
+    The LRUCache is available as the wrapped function's cache attribute.
+    """
+    def decorate(func):
+        cache = LRUCache(maxsize)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                value = func(*args)
+                cache[args] = value
+                return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorate
+
+
+# gnucash stores tax table percentages over this denominator
+PERCENT_DENOM = 100000
+
+
+@memoize(4096)
+def _numeric_parts(text):
+    if text.endswith('%'):
+        decimal_value = Decimal(text[:-1])
+        ispercent = True
+    else:
+        decimal_value = Decimal(text)
+        ispercent = False
+
+    sign, digits, exponent = decimal_value.as_tuple()
+    # The digits with the exponent dropped are the exact numerator
+    numerator = int(Decimal((sign, digits, 0)))
+    if exponent < 0:
+        denominator = 10 ** -exponent
+    else:
+        numerator *= 10 ** exponent
+        denominator = 1
+
+    if ispercent and denominator <= PERCENT_DENOM:
+        scale = PERCENT_DENOM // denominator
+        numerator *= scale
+        denominator = PERCENT_DENOM
+    return numerator, denominator
+
+
+def numeric_parts(value):
+    """Return the exact (numerator, denominator) of a QuickBooks number.
+
+    value is a string such as '-108.30' or '8.3%', or a Decimal. Results
+    are cached by the value's text, so '1' and '1.0' stay distinct.
+    """
+    return _numeric_parts(str(value).strip())
+
+
+# QuickBooks date layouts tried in order; set_date_formats changes them
+DATE_FORMATS = ('%m/%d/%Y',)
+
+
+def set_date_formats(formats):
+    """Use formats, strptime layouts such as '%d/%m/%y', for parse_date."""
+    global DATE_FORMATS
+    DATE_FORMATS = tuple(formats)
+
+
+@memoize(16384)
+def _parse_date(text, formats):
+    for layout in formats:
+        if layout == '%m/%d/%Y':
+            # The QuickBooks default, without strptime
+            parts = text.split('/')
+            if len(parts) == 3 and len(parts[2]) == 4 and \
+                    all(part.isdigit() for part in parts):
+                try:
+                    return datetime.datetime(int(parts[2]), int(parts[0]),
+                                             int(parts[1]))
+                except ValueError:
+                    pass
+            continue
+        try:
+            return datetime.datetime.strptime(text, layout)
+        except ValueError:
+            pass
+    raise ValueError('%r does not match %s' % (text, ' or '.join(formats)))
+
+
+def parse_date(text):
+    """Return the datetime of a QuickBooks date in one of DATE_FORMATS.
+
+    A ledger has few distinct dates, so results are cached by text. Raises
+    ValueError naming the formats tried.
+    """
+    return _parse_date(text.strip(), DATE_FORMATS)
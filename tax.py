@@ -7,6 +7,18 @@ import sys
 import csv
 import os
 import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import deque, namedtuple, OrderedDict
 from decimal import Decimal
 from gnucash import Session, Account, GncNumeric, Query
 from gnucash.gnucash_business import Customer, Vendor, Invoice, Entry, TaxTable, TaxTableEntry, Transaction, Split, Bill
@@ -14,6 +26,11 @@ from gnucash.gnucash_core_c import  ACCT_TYPE_LIABILITY
 
 from lxml import etree as et
 
+from qbutil import numeric_parts, parse_date, set_date_formats
+
+# Text of a tax table entry amount on one line of a GnuCash XML book
+AMOUNT_TEXT = re.compile(r'amount>([^<]*)</')
+
 outfieldnames = (
     'id', 'company', 'name', 'addr1', 'addr2', 'addr3', 'addr4', 'phone', 'fax', 'email', 'notes', 'shipname',
     'shipaddr1', 'shipaddr2', 'shipaddr3', 'shipaddr4', 'shiphone', 'shipfax', 'shipmail')
@@ -23,12 +40,11 @@ outfieldnames = (
 # E.g. 123 Broadway, Kennewick, wa, 143 Georgetown, wa
 # Mr. George Smith
 # Contact: George L. Smith
-# If not in these lists, overwrite with last occurrence in map.
+# If not in these lists, keep the first non-empty column in csv order.
 # Change Bill to 5 from notes to addr4 if want to use commakey.
 # commakey = ('addr4', 'shipaddr4')
 commakey = ()
-# noinspection PyRedundantParentheses
-spacekey = ('notes')
+spacekey = ('notes',)
 linekey = ()
 
 # QuickBooks column head : gnucash columnhead
@@ -132,6 +148,10 @@ transmap = {'Type': 'type',
             'Split': 'split',
             'Amount': 'amount'}
 
+# Just the transaction columns TaxRates.prescan needs
+taxmap = dict((field, transmap[field])
+              for field in ('Type', 'Account', 'Item', 'Sales Price'))
+
 
 def main():
     parser = argparse.ArgumentParser(description='Convert QuickBooks vendor, customer or tax_items csv file to gnucash')
@@ -140,6 +160,44 @@ def main():
     parser.add_argument('--test',
                         action='store_false',
                         help='Process the input but do not update the gnucash')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Parse transactions in this many processes')
+    parser.add_argument('--posted',
+                        metavar='file.posted',
+                        help='Record of transactions already posted, skipped on a re-run '
+                             '(default: file.gnucash.posted)')
+    parser.add_argument('--checkpoint',
+                        metavar='N',
+                        type=int,
+                        default=0,
+                        help='Save the gnucash every N transactions')
+    parser.add_argument('--checkpoint-time',
+                        metavar='SECONDS',
+                        type=float,
+                        default=0,
+                        help='Save the gnucash at most this many seconds apart')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue the transactions after the last checkpoint')
+    parser.add_argument('--bulk',
+                        action='store_true',
+                        help='Diff all customers or vendors against the gnucash first and apply only the changes')
+    parser.add_argument('--date-format',
+                        metavar='FORMAT',
+                        action='append',
+                        help='QuickBooks date layout for strptime, e.g. %%d/%%m/%%y; may be repeated '
+                             '(default: %%m/%%d/%%Y)')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='Report what the transactions would create and post, without opening the gnucash')
+    parser.add_argument('--snapshot',
+                        metavar='snapshot.json',
+                        help='With --plan, a saved snapshot of the gnucash, updated when older than the gnucash')
+    parser.add_argument('--profile',
+                        metavar='profile.json',
+                        help='Time each posting phase and document type, writing a JSON report')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-c', '--customer',
@@ -170,6 +228,15 @@ def main():
     transaction = args.transactions
     path = args.outfile[0]
     GncFile.nosave = args.test
+    if args.profile is not None:
+        Profile.enable()
+    if args.date_format:
+        set_date_formats(args.date_format)
+
+    if args.plan:
+        if transaction is None:
+            parser.error('--plan needs --transactions')
+        return plan(path, transaction, args)
 
     try:
         GncFile.gnc_open(path)
@@ -179,7 +246,8 @@ def main():
         USD = GncFile.USD
 
         # Process the input file
-        reader = csv.DictReader(open(items, 'r'))
+        reader = csv.reader(
+            open(items or customer or vendor or transaction, 'r'))
         if items is not None:
             out = mapqb2gnc(reader, itemap)
             for row in out:
@@ -187,59 +255,194 @@ def main():
 
         if customer is not None:
             out = mapqb2gnc(reader, custmap)
-            for row in out:
-                new_customer(book, row, USD)
+            if args.bulk:
+                GetCustomers.bulk(book, out, new_customer, USD)
+            else:
+                for row in out:
+                    new_customer(book, row, USD)
 
         if vendor is not None:
             out = mapqb2gnc(reader, vendmap)
-            for row in out:
-                new_vendor(book, row, USD)
+            if args.bulk:
+                GetVendors.bulk(book, out, new_vendor, USD)
+            else:
+                for row in out:
+                    new_vendor(book, row, USD)
 
         if transaction is not None:
-            out = mapqb2gnc(reader, transmap)
-            new_transaction(root, book, out, USD)
+            import_transactions(root, book, USD, transaction, args)
 
         GncFile.gnc_save()
-        GncFile.gnc_end()
+        end_session(args)
 
     except:
-        GncFile.gnc_end()
+        end_session(args, failed=True)
         raise
 
     return
 
 
+def read_csv(path):
+    return csv.reader(open(path, 'r'))
+
+
+def import_transactions(root, book, USD, transaction, args, read=read_csv):
+    # The transactions stage of main and migrate.py: settle tax rates, then
+    # post the documents not already posted, saving at checkpoints. read
+    # opens the export as csv rows. Returns the number of documents.
+    export = transaction
+    if not os.path.isfile(transaction):
+        # The export is read twice, so copy a pipe to a file first
+        with open(transaction, 'rb') as source:
+            spool = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+            with spool:
+                shutil.copyfileobj(source, spool)
+        export = spool.name
+    try:
+        Posted.open(args.posted or GncFile.path + '.posted')
+        # Settle tax rates in one pass before anything is posted
+        TaxRates.reconcile(book, TaxRates.prescan(
+            mapqb2gnc(read(export), taxmap)))
+        if args.jobs > 1:
+            documents = parse_parallel(read(export), args.jobs)
+        else:
+            documents = parse_documents(mapqb2gnc(read(export), transmap))
+        count = [0]
+
+        def counted():
+            for document in checkpointed(documents, transaction, args.checkpoint,
+                                         args.checkpoint_time, args.resume):
+                count[0] += 1
+                yield document
+
+        new_transaction(root, book, counted(), USD)
+        return count[0]
+    finally:
+        if export != transaction:
+            os.remove(export)
+
+
+def end_session(args, failed=False):
+    # Close the book and the posted store and report, after gnc_save or,
+    # with failed, after an error
+    GncFile.gnc_end()
+    Posted.close()
+    Accounts.report()
+    if not failed:
+        Profile.report(args.profile)
+
+
+def plan(path, transaction, args):
+    # --plan: check the transactions against a snapshot of the book
+    snapshot = Snapshot.open(path, args.snapshot)
+    posted = args.posted or path + '.posted'
+    if os.path.exists(posted):
+        Posted.open(posted)
+    try:
+        TaxRates.plan(snapshot, TaxRates.prescan(
+            mapqb2gnc(csv.reader(open(transaction, 'r')), taxmap)))
+        problems = plan_transactions(snapshot, parse_documents(
+            mapqb2gnc(csv.reader(open(transaction, 'r')), transmap)))
+    finally:
+        # Nothing was posted, so nothing to commit or count
+        Posted.counts = {}
+        Posted.close()
+    return 1 if problems else 0
+
+
 class TaxRates(object):
+    # (QuickBooks tax item, rate) -> name of the GnuCash tax table to use
     ratetable = {}
 
     @classmethod
-    def israte(cls, tablename, rate):
-        if tablename in TaxRates.ratetable.keys():
-            oldrate = TaxRates.ratetable[str(tablename)]
-            if rate.to_string() != oldrate.to_string():
-                TaxRates.ratetable[str(tablename)] = rate
-                if GncFile.nosave:
-                    print "Current TaxTable %s rate: %s" % (tablename, oldrate)
-                    print "Update TaxTable %s rate: %s" % (tablename, rate)
-                    GncFile.gnc_save()
-                    GncFile.gnc_end()
-                    raw_input('After you save & exit GnuCash, press Enter')
-                    GncFile.gnc_open()
+    def prescan(cls, rows):
+        # Collect every tax item and the rates it is charged at, in order
+        rates = OrderedDict()
+        for document in get_documents(rows):
+            for row in document[1:-1]:
+                if row['account'] == 'Sales Tax Payable' and 'price' in row:
+                    rate = numeric_parts(row['price'])
+                    itemrates = rates.setdefault(row['item'], [])
+                    if rate not in itemrates:
+                        itemrates.append(rate)
+        return rates
+
+    @classmethod
+    def reconcile(cls, book, rates):
+        # Settle every rate before posting starts: a rate that differs from
+        # the book's table gets its own table, so posting never has to stop
+        # for a rate change or reload the book.
+        conflicts = []
+        missing = []
+        for tablename, itemrates in rates.iteritems():
+            table = book.TaxTableLookupByName(tablename)
+            if not isinstance(table, TaxTable):
+                missing.append(tablename)
+                continue
+            entry = table.GetEntries()[0]
+            for rate in itemrates:
+                if same_rate(rate, entry.GetAmount()):
+                    TaxRates.ratetable[(tablename, rate)] = tablename
                 else:
-                    print("Check TaxTable %s rate: %s, before running " +
-                          "without --test") % (tablename, oldrate)
-            return True
-        else:
-            TaxRates.ratetable[str(tablename)] = rate
-            return False
+                    conflicts.append((tablename, entry, rate))
+        if missing:
+            # Every invoice or bill using these would fail mid-run
+            for tablename in missing:
+                print 'TaxTable %s does not exist' % tablename
+            raise Exception('GnuCash tax table missing')
+
+        for tablename, entry, rate in conflicts:
+            ratename = '%s (%s%%)' % (
+                tablename, Decimal(rate[0]) / Decimal(rate[1]))
+            print "TaxTable %s rate: %s, file rate: %s, using TaxTable %s" \
+                  % (tablename, entry.GetAmount().to_string(),
+                     GncNumeric(*rate).to_string(), ratename)
+            table = book.TaxTableLookupByName(ratename)
+            if not isinstance(table, TaxTable):
+                TaxTable(book, ratename, TaxTableEntry(
+                    entry.GetAccount(), True, GncNumeric(*rate)))
+            elif not same_rate(rate, table.GetEntries()[0].GetAmount()):
+                print "Check TaxTable %s rate" % ratename
+            TaxRates.ratetable[(tablename, rate)] = ratename
+        return len(conflicts)
+
+    @classmethod
+    def plan(cls, snapshot, rates):
+        # reconcile against a Snapshot: report the tables it would create
+        conflicts = 0
+        for tablename, itemrates in rates.iteritems():
+            amount = snapshot.taxtables.get(tablename)
+            if tablename not in snapshot.taxtables:
+                print 'TaxTable %s does not exist' % tablename
+                continue
+            for rate in itemrates:
+                if amount is not None and rate[0] * amount[1] == amount[0] * rate[1]:
+                    TaxRates.ratetable[(tablename, rate)] = tablename
+                    continue
+                ratename = '%s (%s%%)' % (tablename, Decimal(rate[0]) / Decimal(rate[1]))
+                if ratename not in snapshot.taxtables:
+                    print 'create TaxTable %s' % ratename
+                TaxRates.ratetable[(tablename, rate)] = ratename
+                conflicts += 1
+        return conflicts
+
+    @classmethod
+    def tablename(cls, tablename, rate):
+        return TaxRates.ratetable.get((tablename, rate), tablename)
+
+
+def same_rate(rate, amount):
+    # Compare a (num, denom) rate with a GncNumeric without rounding
+    return rate[0] * amount.denom() == amount.num() * rate[1]
 
 
 def new_tax(root, book, USD, row):
     if row['type'] == 'Sales Tax Item':
         tablename = row['item']
-        parent = root.lookup_by_name(row['account'])
+        parent = Accounts.lookup(row['account'], row)
         account = Account(book)
         parent.append_child(account)
+        Accounts.invalidate()
         account.SetName(tablename)
         account.SetType(ACCT_TYPE_LIABILITY)
         account.SetCommodity(USD)
@@ -260,53 +463,15 @@ def new_tax(root, book, USD, row):
 
 def new_customer(book, row, USD):
     # Assume customer exists. Check id and company for new customer.
-    cid = ''
-    testcompany = None
-
     if 'company' in row.keys():
         company = row['company']
     else:
         print "Company missing in %s" % row
         return 1
 
-        # Get company and ID from existing Customers
-    try:
-        testcompany = GetCustomers.iscustomer(company)
-        cid = testcompany.GetID()
-    except AttributeError:
-        pass
-
-    if 'id' in row.keys():
-        if row['id'] != cid:
-            cid = row['id']
-            testid = book.CustomerLookupByID(cid)
-        else:
-            testid = testcompany
-    else:
-        testid = None
-
-    if testid is None and testcompany is None:
-        # If ID missing, create one
-        if not cid:
-            cid = book.CustomerNextID()
-        # Customer not found, create.
-        cust_acct = Customer(book, cid, USD, company)
-    elif testid == testcompany:
-        # ID and Company match, use.
-        cust_acct = testid
-    elif testid is not None and testcompany is None:
-        # Customer found by ID, update Company
-        cust_acct = testid
-        cust_acct.SetCompany(company)
-#    elif testid is None and testcompany is not None:
-    else:
-        if not cid:
-            # Customer found by Company, ID missing, use.
-            cust_acct = testcompany
-        else:
-            # Customer found by Company, update ID
-            cust_acct = testcompany
-            cust_acct.SetID(cid)
+    # Find the customer by company and ID, creating or updating it
+    action, cust_acct, cid = GetCustomers.classify(row)
+    cust_acct = GetCustomers.resolve(book, USD, action, cust_acct, company, cid)
 
     try:
         assert (isinstance(cust_acct, Customer))
@@ -376,53 +541,16 @@ def new_customer(book, row, USD):
 
 
 def new_vendor(book, row, USD):
-    # Assume vendomer exists. Check id and company for new vendor.
-    cid = ''
-    testcompany = None
-
+    # Assume vendor exists. Check id and company for new vendor.
     if 'company' in row.keys():
         company = row['company']
     else:
         print "Company missing in %s" % row
         return 1
-        # Get company and ID from existing Vendors
-    try:
-        testcompany = GetVendors.isvendor(company)
-        cid = testcompany.GetID()
-    except AttributeError:
-        pass
-
-    if 'id' in row.keys():
-        if row['id'] != cid:
-            cid = row['id']
-            testid = book.VendorLookupByID(cid)
-        else:
-            testid = testcompany
-    else:
-        testid = None
-
-    if testid is None and testcompany is None:
-        # If ID missing, create one
-        if not cid:
-            cid = book.VendorNextID()
-        # Vendor not found, create.
-        vend_acct = Vendor(book, cid, USD, company)
-    elif testid == testcompany:
-        # ID and Company match, use.
-        vend_acct = testid
-    elif testid is not None and testcompany is None:
-        # Vendor found by ID, update Company
-        vend_acct = testid
-        vend_acct.SetCompany(company)
-    # elif testid is None and testcompany is not None:
-    else:
-        if not cid:
-            # Vendor found by Company, ID missing, use.
-            vend_acct = testcompany
-        else:
-            # Vendor found by Company, update ID
-            vend_acct = testcompany
-            vend_acct.SetID(cid)
+
+    # Find the vendor by company and ID, creating or updating it
+    action, vend_acct, cid = GetVendors.classify(row)
+    vend_acct = GetVendors.resolve(book, USD, action, vend_acct, company, cid)
 
     try:
         assert (isinstance(vend_acct, Vendor))
@@ -477,509 +605,1017 @@ def new_vendor(book, row, USD):
     return 0
 
 
-def new_transaction(root, book, out, USD):
-    # global existing_customers, existing_vendors
-    # Assemble the invoice dictionary
-    isinvoice = False
-    isbill = False
-    isinvpayment = False
-    isbillpayment = False
-    isentry = False
-
-    for row in out:
-        if 'type' in row.keys():
-            rtype = row['type']
+def checkpointed(documents, export, every=0, seconds=0, resume=False):
+    # Save the book every `every` documents or `seconds` seconds, recording
+    # how many documents of export are done; with resume, start after the
+    # documents done as of the last save.
+    done, mark = 0, None
+    if resume:
+        done, mark = Posted.checkpoint(export)
+        print 'Resuming %s after %d documents' % (export, done)
+    index, last = -1, None
+    saved = time.time()
+    for index, document in enumerate(documents):
+        if index < done:
+            if not Posters.ignored(document.type):
+                # Keep the duplicate counts in fingerprints as a full run would
+                Posted.fingerprint(document)
+            if index == done - 1 and document_mark(document) != mark:
+                raise Exception('Document %d of %s is not the one checkpointed; the export has changed, '
+                                're-run without --resume' % (done, export))
+            continue
+        if index > done and (every and (index - done) % every == 0 or
+                             seconds and time.time() - saved >= seconds):
+            Posted.reached(export, index, document_mark(last))
+            GncFile.gnc_save()
+            if GncFile.nosave:
+                print 'Checkpoint: %d documents' % index
+            saved = time.time()
+        last = document
+        yield document
+    if index + 1 < done:
+        raise Exception('%s has fewer than the %d documents checkpointed' % (export, done))
+    if index >= done:
+        Posted.reached(export, index + 1, document_mark(last))
+
+
+def document_mark(document):
+    # Enough of a document to recognise it again in the same export
+    if document is None:
+        return None
+    return repr((document.type, document.num, document.owner,
+                 document.date_opened.isoformat(), document.amount))
+
+
+def plan_transactions(snapshot, documents):
+    # Report what new_transaction would create and post for documents,
+    # checking owners, accounts and tax tables against snapshot alone.
+    # Returns the number of problems that would stop or skip a document.
+    counts = OrderedDict()
+    problems = 0
+    for document in documents:
+        rtype = document.type
+        if Posters.ignored(rtype):
+            continue
+        if Posted.skip(document):
+            counts['already posted'] = counts.get('already posted', 0) + 1
+            continue
+        label = '%s %s %s %s' % (rtype, (document.num or ''), (document.owner or ''),
+                                 document.date_opened.strftime('%m/%d/%Y'))
+
+        poster, owners, planner = Posters.entry(rtype)
+        if owners is not None and document.owner not in snapshot.owners(owners):
+            print 'skip %s: owner does not exist' % label
+            counts['skipped'] = counts.get('skipped', 0) + 1
+            problems += 1
+            continue
+
+        accounts, action, missing = planner(snapshot, document)
+        missing.extend('account %s' % name for name in accounts if not snapshot.account(name))
+
+        if missing:
+            print 'fail %s: %s missing' % (label, ', '.join(missing))
+            counts['failed'] = counts.get('failed', 0) + 1
+            problems += 1
         else:
-            rtype = ''
-
-        if rtype:
-            new_rtype, date_opened = get_rtype(row)
-            new_rtype['entries'] = []
-
-            if rtype == 'Invoice':
-                isinvoice = True
-            elif rtype == 'Payment':
-                isinvpayment = True
-            elif rtype == 'Sales Tax Payment':
-                isentry = True
-            elif rtype == 'Paycheck':
-                continue
-            elif rtype == 'Bill':
-                isbill = True
-            elif rtype == 'Credit':
-                isbill = True
-            elif rtype == 'Bill Pmt -CCard':
-                isbillpayment = True
-            else:
-                isentry = True
-
-        elif 'account' in row.keys():
-            if row['account']:
-                test, new_entry = get_entries(row, date_opened)
-                if test == 'tax_table':
-                    new_rtype['tax_table'] = new_entry['tax_table']
-                    new_rtype['tax_rate'] = new_entry['price']
-                elif test == 'entry':
-                    new_rtype['entries'].append(new_entry)
-
-                    # No account in total row, so process entries
-        elif isentry:
-            trans1 = Transaction(book)
-            trans1.BeginEdit()
-            trans1.SetCurrency(USD)
-            if 'owner' in new_rtype.keys():
-                trans1.SetDescription(new_rtype['owner'])
-            trans1.SetDateEnteredTS(
-                new_rtype['date_opened'] + datetime.timedelta(microseconds=1))
-            trans1.SetDatePostedTS(
-                new_rtype['date_opened'] + datetime.timedelta(microseconds=1))
-            if 'num' in new_rtype.keys():
-                trans1.SetNum(new_rtype['num'])
-            if 'notes' in new_rtype.keys():
-                trans1.SetNotes = new_rtype['notes']
-
-            if new_rtype['account'] != '-SPLIT-':
-                split1 = Split(book)
-                split1.SetParent(trans1)
-                # if new_rtype['type'] == 'Deposit':
-                # new_rtype['amount'] = new_rtype['amount'].neg()
-                split1.SetAccount(root.lookup_by_name(new_rtype['account']))
-                # if split1.GetAccount() == ACCT_TYPE_EQUITY:
-                # isequity = True
-                # new_rtype['amount'] = new_rtype['amount'].neg()
-                # else:
-                # isequity = False
-                split1.SetValue(new_rtype['amount'])
-                if 'owner' in new_rtype.keys():
-                    split1.SetMemo(new_rtype['owner'])
-                    # split1.SetAction(get_action(new_rtype['type']))
-
-            for entry in new_rtype['entries']:
-                if 'amount' in entry.keys():
-                    split1 = Split(book)
-                    split1.SetParent(trans1)
-                    # if isequity:
-                    # entry['amount'] = entry['amount'].neg()
-                    split1.SetValue(entry['amount'])
-                    split1.SetAccount(root.lookup_by_name(entry['account']))
-                    if 'description' in entry.keys():
-                        split1.SetMemo(entry['description'])
-            # split1.SetAction(get_action(new_rtype['type']))
-            trans1.CommitEdit()
-
-            isentry = False
-
-        elif isinvpayment:
-            try:
-                owner = GetCustomers.iscustomer(new_rtype['owner'])
-                assert (isinstance(owner, Customer))
-            except AssertionError:
-                print 'Customer %s does not exist; skipping' % \
-                      new_rtype['owner']
-                continue
+            print '%s: %s' % (label, action)
+            counts[rtype] = counts.get(rtype, 0) + 1
+    print ', '.join('%s: %d' % item for item in counts.iteritems())
+    return problems
+
+
+# Planners for plan_transactions: what the poster of a document would do,
+# as (accounts it posts to, action, missing tax tables)
+def plan_journal(snapshot, document):
+    # A split for the header unless split, and one per entry with an amount
+    accounts = [entry.account for entry in document.entries if entry.amount is not None]
+    if document.account != '-SPLIT-':
+        accounts.append(document.account)
+    return accounts, 'post transaction with %d splits' % len(accounts), []
+
+
+def plan_payment(snapshot, document):
+    accounts = [entry.account for entry in document.entries] + [document.account]
+    return accounts, 'apply %d payments' % len(document.entries), []
+
+
+def plan_business(snapshot, document, entries):
+    # Invoices and bills: a document with entries, posted with its tax table
+    accounts = [entry.account for entry in entries] + [document.account]
+    action = 'create %s with %d entries and post' % (document.type.lower(), len(entries))
+    missing = []
+    if document.tax_table is not None:
+        tablename = TaxRates.tablename(document.tax_table, document.tax_rate)
+        if tablename not in snapshot.taxtables and \
+                tablename not in TaxRates.ratetable.values():
+            missing.append('tax table %s' % tablename)
+    return accounts, action, missing
+
+
+def plan_invoice(snapshot, document):
+    return plan_business(snapshot, document, document.entries)
+
+
+def plan_bill(snapshot, document):
+    # post_bill skips entries that link COGS and inventory
+    return plan_business(snapshot, document,
+                         [entry for entry in document.entries if entry.quantity is not None])
+
+
+def new_transaction(root, book, documents, USD):
+    # Post parsed QuickBooks documents (see parse_document) in order, each
+    # with the poster Posters has for its type
+    for new_rtype in documents:
+        rtype = new_rtype.type
+        poster = Posters.lookup(rtype)
+        if poster is None:
+            continue
+        if Posted.skip(new_rtype):
+            continue
+        posting = Profile.start()
+        gnc_id = poster(book, new_rtype, USD)
+        if gnc_id is None:
+            # Skipped, e.g. for a missing owner
+            continue
+        Posted.add(gnc_id or None)
+        Profile.document(rtype, posting)
 
-            xfer_acc = root.lookup_by_name(new_rtype['account'])
-            date_opened = new_rtype['date_opened']
-            if 'notes' in new_rtype.keys():
-                notes = new_rtype['notes']
-            else:
-                notes = ''
-            if 'num' in new_rtype.keys():
-                num = new_rtype['num']
-            else:
-                num = ''
-            for entry in new_rtype['entries']:
-                posted_acc = root.lookup_by_name(entry['account'])
+    return 0
 
-                owner.ApplyPayment(None, None, posted_acc, xfer_acc,
-                                   new_rtype['amount'], entry['amount'],
-                                   date_opened, notes, num, False)
-            isinvpayment = False
 
-        elif isbillpayment:
-            try:
-                owner = GetVendors.isvendor(new_rtype['owner'])
-                assert (isinstance(owner, Vendor))
-            except AssertionError:
-                print 'Vendor %s does not exist; skipping' % \
-                      new_rtype['owner']
-                continue
+def post_journal(book, new_rtype, USD):
+    # Types without a poster of their own: a transaction with a split for
+    # the header, unless it is split, and one for each entry with an amount
+    trans1 = Transaction(book)
+    trans1.BeginEdit()
+    trans1.SetCurrency(USD)
+    if new_rtype.owner is not None:
+        trans1.SetDescription(new_rtype.owner)
+    trans1.SetDateEnteredTS(
+        new_rtype.date_opened + datetime.timedelta(microseconds=1))
+    trans1.SetDatePostedTS(
+        new_rtype.date_opened + datetime.timedelta(microseconds=1))
+    if new_rtype.num is not None:
+        trans1.SetNum(new_rtype.num)
+    if new_rtype.notes is not None:
+        trans1.SetNotes = new_rtype.notes
+
+    if new_rtype.account != '-SPLIT-':
+        split1 = Split(book)
+        split1.SetParent(trans1)
+        # if new_rtype.type == 'Deposit':
+        # new_rtype.amount = new_rtype.amount.neg()
+        split1.SetAccount(
+            Accounts.lookup(new_rtype.account, new_rtype))
+        # if split1.GetAccount() == ACCT_TYPE_EQUITY:
+        # isequity = True
+        # new_rtype.amount = new_rtype.amount.neg()
+        # else:
+        # isequity = False
+        split1.SetValue(GncNumeric(*new_rtype.amount))
+        if new_rtype.owner is not None:
+            split1.SetMemo(new_rtype.owner)
+            # split1.SetAction(get_action(new_rtype.type))
+
+    for entry in new_rtype.entries:
+        if entry.amount is not None:
+            split1 = Split(book)
+            split1.SetParent(trans1)
+            # if isequity:
+            # entry.amount = entry.amount.neg()
+            split1.SetValue(GncNumeric(*entry.amount))
+            split1.SetAccount(Accounts.lookup(entry.account, entry))
+            if entry.description is not None:
+                split1.SetMemo(entry.description)
+    # split1.SetAction(get_action(new_rtype.type))
+    trans1.CommitEdit()
+    return ''
+
+
+# new_customer.ApplyPayment(self, invoice, posted_acc, xfer_acc, amount,
+# exch, date, memo, num)
+# new_customer.ApplyPayment(None, None, a2, a6, GncNumeric(100,100),
+# GncNumeric(1), datetime.date.today(), "", "", False)
+
+# invoice_customer.ApplyPayment(None, a6, GncNumeric(7,100),
+# GncNumeric(1), datetime.date.today(), "", "")
+def post_payment(owners, book, new_rtype, USD):
+    # Apply a payment to the documents of a GetCustomers or GetVendors owner
+    started = Profile.start()
+    owner = owners.lookup_name(new_rtype.owner)
+    Profile.stop('owner lookup', started)
+    try:
+        assert (isinstance(owner, owners.owner_class))
+    except AssertionError:
+        print '%s %s does not exist; skipping' % \
+              (owners.owner_class.__name__, new_rtype.owner)
+        return None
 
-            xfer_acc = root.lookup_by_name(new_rtype['account'])
-            date_opened = new_rtype['date_opened']
-            if 'notes' in new_rtype.keys():
-                notes = new_rtype['notes']
-            else:
-                notes = ''
-            if 'num' in new_rtype.keys():
-                num = new_rtype['num']
-            else:
-                num = ''
-            for entry in new_rtype['entries']:
-                posted_acc = root.lookup_by_name(entry['account'])
-
-                owner.ApplyPayment(None, None, posted_acc, xfer_acc,
-                                   new_rtype['amount'], entry['amount'],
-                                   date_opened, notes, num, False)
-            isbillpayment = False
-
-        # new_customer.ApplyPayment(self, invoice, posted_acc, xfer_acc, amount,
-        # exch, date, memo, num)
-        # new_customer.ApplyPayment(None, None, a2, a6, GncNumeric(100,100),
-        # GncNumeric(1), datetime.date.today(), "", "", False)
-
-        # invoice_customer.ApplyPayment(None, a6, GncNumeric(7,100),
-        # GncNumeric(1), datetime.date.today(), "", "")
-
-        elif isbill:
-            # put item on entries!!!
-            # Accumulate splits
-            # QuickBooks Journal has a total row after splits,
-            # which is used to detect the end of splits.
-            try:
-                owner = GetVendors.isvendor(new_rtype['owner'])
-                assert (isinstance(owner, Vendor))
-            except AssertionError:
-                print 'Vendor %s does not exist; skipping' % \
-                      new_rtype['owner']
-                continue
+    xfer_acc = Accounts.lookup(new_rtype.account, new_rtype)
+    date_opened = new_rtype.date_opened
+    if new_rtype.notes is not None:
+        notes = new_rtype.notes
+    else:
+        notes = ''
+    if new_rtype.num is not None:
+        num = new_rtype.num
+    else:
+        num = ''
+    for entry in new_rtype.entries:
+        posted_acc = Accounts.lookup(entry.account, entry)
 
-            try:
-                cid = book.BillNextID(owner)
-            # save Bill ID and tax rate for xml overlay.
-            # ReplaceTax.bill(cid, new_rtype['tax_rate'])
-            except:
-                raise
+        started = Profile.start()
+        owner.ApplyPayment(None, None, posted_acc, xfer_acc,
+                           GncNumeric(*new_rtype.amount),
+                           GncNumeric(*entry.amount),
+                           date_opened, notes, num, False)
+        Profile.stop('ApplyPayment', started)
+    return ''
 
-            bill_vendor = Bill(book, cid, USD, owner)
-            vendor_extract = bill_vendor.GetOwner()
-            assert (isinstance(vendor_extract, Vendor))
-            assert (vendor_extract.GetName() == owner.GetName())
 
-            if new_rtype['type'] == 'Credit':
-                bill_vendor.SetIsCreditNote(True)
+def post_customer_payment(book, new_rtype, USD):
+    return post_payment(GetCustomers, book, new_rtype, USD)
 
-            bill_vendor.SetDateOpened(new_rtype['date_opened'])
 
-            if 'notes' in new_rtype.keys():
-                bill_vendor.SetNotes(new_rtype['notes'])
+def post_vendor_payment(book, new_rtype, USD):
+    return post_payment(GetVendors, book, new_rtype, USD)
 
-            if 'num' in new_rtype.keys():
-                bill_vendor.SetBillingID(new_rtype['num'])
 
-            if 'tax_table' in new_rtype.keys():
-                tax_table = book.TaxTableLookupByName(new_rtype['tax_table'])
-                assert (isinstance(tax_table, TaxTable))
+def post_bill(book, new_rtype, USD):
+    # Bills and vendor credits, returning the bill ID
+    # put item on entries!!!
+    # Accumulate splits
+    # QuickBooks Journal has a total row after splits,
+    # which is used to detect the end of splits.
+    started = Profile.start()
+    owner = GetVendors.isvendor(new_rtype.owner)
+    Profile.stop('owner lookup', started)
+    try:
+        assert (isinstance(owner, Vendor))
+    except AssertionError:
+        print 'Vendor %s does not exist; skipping' % \
+              new_rtype.owner
+        return None
 
-            # Add the entries
-            for entry in new_rtype['entries']:
-                # skip entries that link COGS and Billentory
-                if 'quantity' not in entry.keys():
-                    continue
-                bill_entry = Entry(book, bill_vendor)
+    try:
+        cid = book.BillNextID(owner)
+    # save Bill ID and tax rate for xml overlay.
+    # ReplaceTax.bill(cid, new_rtype.tax_rate)
+    except:
+        raise
 
-                account = root.lookup_by_name(entry['account'])
-                assert (isinstance(account, Account))
-                bill_entry.SetBillAccount(account)
+    bill_vendor = Bill(book, cid, USD, owner)
+    vendor_extract = bill_vendor.GetOwner()
+    assert (isinstance(vendor_extract, Vendor))
+    assert (vendor_extract.GetName() == owner.GetName())
 
-                if 'tax_table' in new_rtype.keys():
-                    bill_entry.SetBillTaxTable(tax_table)
-                    bill_entry.SetBillTaxIncluded(False)
-                else:
-                    bill_entry.SetBillTaxable(False)
-
-                if 'description' in entry.keys():
-                    bill_entry.SetDescription(entry['description'])
-                bill_entry.SetQuantity(entry['quantity'])
-                bill_entry.SetBillPrice(entry['price'])
-                bill_entry.SetDateEntered(entry['date'])
-                bill_entry.SetDate(entry['date'])
-                if 'notes' in entry.keys():
-                    bill_entry.SetNotes(entry['notes'])
-
-            isbill = False
-
-            # Post bill
-            account = root.lookup_by_name(new_rtype['account'])
-            assert (isinstance(account, Account))
-            bill_vendor.PostToAccount(account, new_rtype['date_opened'], new_rtype['date_opened'],
-                                      str(new_rtype['owner']), True, False)
-
-        elif isinvoice:
-            # put item on entries!!!
-            # Accumulate splits
-            # QuickBooks Journal has a total row after splits,
-            # which is used to detect the end of splits.
-            try:
-                owner = GetCustomers.iscustomer(new_rtype['owner'])
-                assert (isinstance(owner, Customer))
-            except AssertionError:
-                print 'Customer %s does not exist; skipping' % \
-                      new_rtype['owner']
-                continue
+    if new_rtype.type == 'Credit':
+        bill_vendor.SetIsCreditNote(True)
 
-            try:
-                cid = book.InvoiceNextID(owner)
-            # save Invoice ID and tax rate for xml overlay.
-            # ReplaceTax.invoice(cid, new_rtype['tax_rate'])
-            except:
-                raise
+    bill_vendor.SetDateOpened(new_rtype.date_opened)
 
-            invoice_customer = Invoice(book, cid, USD, owner)
-            customer_extract = invoice_customer.GetOwner()
-            assert (isinstance(customer_extract, Customer))
-            assert (customer_extract.GetName() == owner.GetName())
+    if new_rtype.notes is not None:
+        bill_vendor.SetNotes(new_rtype.notes)
 
-            invoice_customer.SetDateOpened(new_rtype['date_opened'])
+    if new_rtype.num is not None:
+        bill_vendor.SetBillingID(new_rtype.num)
 
-            if 'notes' in new_rtype.keys():
-                invoice_customer.SetNotes(new_rtype['notes'])
+    if new_rtype.tax_table is not None:
+        tax_table = book.TaxTableLookupByName(TaxRates.tablename(
+            new_rtype.tax_table, new_rtype.tax_rate))
+        assert (isinstance(tax_table, TaxTable))
 
-            if 'num' in new_rtype.keys():
-                invoice_customer.SetBillingID(new_rtype['num'])
+    # Add the entries
+    for entry in new_rtype.entries:
+        # skip entries that link COGS and Billentory
+        if entry.quantity is None:
+            continue
+        account = Accounts.lookup(entry.account, entry)
 
-            if 'tax_table' in new_rtype.keys():
-                tax_table = book.TaxTableLookupByName(new_rtype['tax_table'])
-                assert (isinstance(tax_table, TaxTable))
+        started = Profile.start()
+        bill_entry = Entry(book, bill_vendor)
+        bill_entry.SetBillAccount(account)
 
-            # assert( not isinstance( \
-            # book.InvoiceLookupByID(new_rtype['id']), Invoice))
+        if new_rtype.tax_table is not None:
+            bill_entry.SetBillTaxTable(tax_table)
+            bill_entry.SetBillTaxIncluded(False)
+        else:
+            bill_entry.SetBillTaxable(False)
+
+        if entry.description is not None:
+            bill_entry.SetDescription(entry.description)
+        bill_entry.SetQuantity(GncNumeric(*entry.quantity))
+        bill_entry.SetBillPrice(GncNumeric(*entry.price))
+        bill_entry.SetDateEntered(entry.date)
+        bill_entry.SetDate(entry.date)
+        if entry.notes is not None:
+            bill_entry.SetNotes(entry.notes)
+        Profile.stop('Entry', started)
+
+    # Post bill
+    account = Accounts.lookup(new_rtype.account, new_rtype)
+    started = Profile.start()
+    bill_vendor.PostToAccount(account, new_rtype.date_opened, new_rtype.date_opened,
+                              str(new_rtype.owner), True, False)
+    Profile.stop('PostToAccount', started)
+    return cid
+
+
+def post_invoice(book, new_rtype, USD):
+    # put item on entries!!!
+    # Accumulate splits
+    # QuickBooks Journal has a total row after splits,
+    # which is used to detect the end of splits.
+    started = Profile.start()
+    owner = GetCustomers.iscustomer(new_rtype.owner)
+    Profile.stop('owner lookup', started)
+    try:
+        assert (isinstance(owner, Customer))
+    except AssertionError:
+        print 'Customer %s does not exist; skipping' % \
+              new_rtype.owner
+        return None
 
-            # Add the entries
-            for entry in new_rtype['entries']:
-                invoice_entry = Entry(book, invoice_customer)
+    try:
+        cid = book.InvoiceNextID(owner)
+    # save Invoice ID and tax rate for xml overlay.
+    # ReplaceTax.invoice(cid, new_rtype.tax_rate)
+    except:
+        raise
 
-                account = root.lookup_by_name(entry['account'])
-                assert (isinstance(account, Account))
-                invoice_entry.SetInvAccount(account)
+    invoice_customer = Invoice(book, cid, USD, owner)
+    customer_extract = invoice_customer.GetOwner()
+    assert (isinstance(customer_extract, Customer))
+    assert (customer_extract.GetName() == owner.GetName())
 
-                if 'tax_table' in new_rtype.keys():
-                    invoice_entry.SetInvTaxTable(tax_table)
-                    invoice_entry.SetInvTaxIncluded(False)
-                else:
-                    invoice_entry.SetInvTaxable(False)
+    invoice_customer.SetDateOpened(new_rtype.date_opened)
 
-                invoice_entry.SetDescription(entry['description'])
-                invoice_entry.SetQuantity(entry['quantity'])
-                invoice_entry.SetInvPrice(entry['price'])
-                invoice_entry.SetDateEntered(entry['date'])
-                invoice_entry.SetDate(entry['date'])
-                if 'notes' in entry.keys():
-                    invoice_entry.SetNotes(entry['notes'])
+    if new_rtype.notes is not None:
+        invoice_customer.SetNotes(new_rtype.notes)
 
-            isinvoice = False
+    if new_rtype.num is not None:
+        invoice_customer.SetBillingID(new_rtype.num)
 
-            # Post invoice
-            account = root.lookup_by_name(new_rtype['account'])
-            assert (isinstance(account, Account))
-            invoice_customer.PostToAccount(account, new_rtype['date_opened'], new_rtype['date_opened'],
-                                           str(new_rtype['owner']), True, False)
-            # ReplaceTax.replace(gnc_file.path)
+    if new_rtype.tax_table is not None:
+        tax_table = book.TaxTableLookupByName(TaxRates.tablename(
+            new_rtype.tax_table, new_rtype.tax_rate))
+        assert (isinstance(tax_table, TaxTable))
 
-    return 0
+    # assert( not isinstance( \
+    # book.InvoiceLookupByID(new_rtype.id), Invoice))
+
+    # Add the entries
+    for entry in new_rtype.entries:
+        account = Accounts.lookup(entry.account, entry)
+
+        started = Profile.start()
+        invoice_entry = Entry(book, invoice_customer)
+        invoice_entry.SetInvAccount(account)
+
+        if new_rtype.tax_table is not None:
+            invoice_entry.SetInvTaxTable(tax_table)
+            invoice_entry.SetInvTaxIncluded(False)
+        else:
+            invoice_entry.SetInvTaxable(False)
+
+        invoice_entry.SetDescription(entry.description)
+        invoice_entry.SetQuantity(GncNumeric(*entry.quantity))
+        invoice_entry.SetInvPrice(GncNumeric(*entry.price))
+        invoice_entry.SetDateEntered(entry.date)
+        invoice_entry.SetDate(entry.date)
+        if entry.notes is not None:
+            invoice_entry.SetNotes(entry.notes)
+        Profile.stop('Entry', started)
+
+    # Post invoice
+    account = Accounts.lookup(new_rtype.account, new_rtype)
+    started = Profile.start()
+    invoice_customer.PostToAccount(account, new_rtype.date_opened, new_rtype.date_opened,
+                                   str(new_rtype.owner), True, False)
+    Profile.stop('PostToAccount', started)
+    # ReplaceTax.replace(gnc_file.path)
+    return cid
 
 
 def pad_number(num):
     return "%(number)06d" % {'number': num}
 
 
+def compile_map(fieldnames, usemap):
+    # Compile a QuickBooks to gnucash map against the csv header once.
+    # Each step is (column index, gnucash field, text that joins a repeated
+    # field or None to keep the first value), in csv column order.
+    plan = []
+    for field in usemap:
+        if usemap[field] != 'not mapped' and field not in fieldnames:
+            raise KeyError(field)
+    for index, field in enumerate(fieldnames):
+        target = usemap.get(field, 'not mapped')
+        if target == 'not mapped':
+            continue
+        if target in commakey:
+            join = ', '
+        elif target in spacekey:
+            join = ' '
+        elif target in linekey:
+            join = '\n' + field + ': '
+        else:
+            join = None
+        plan.append((index, target, join))
+    return plan
+
+
 def mapqb2gnc(reader, usemap):
-    # map QuickBooks csv data to GnuCash csv data
-    out = []
+    # map QuickBooks csv data to GnuCash csv data, one row at a time.
+    # reader is a csv.reader positioned on the header row.
+    fieldnames = next(reader)
+    plan = compile_map(fieldnames, usemap)
+    width = len(fieldnames)
     for row in reader:
+        if not row:
+            # Blank line, skipped as csv.DictReader does
+            continue
+        if len(row) < width:
+            row += [''] * (width - len(row))
         outrow = {}
-        for field in usemap:
-            test = row[str(field)]
-            if usemap[str(field)] == 'not mapped' or \
-                    not test:
+        for index, target, join in plan:
+            value = row[index]
+            if not value:
                 continue
-            elif str((usemap[str(field)])) in outrow:
-                if usemap[str(field)] in commakey:
-                    outrow[usemap[str(field)]] += ', ' + \
-                                                  row[str(field)]
-                elif usemap[str(field)] in spacekey:
-                    outrow[usemap[str(field)]] += ' ' + row[str(field)]
-                elif usemap[str(field)] in linekey:
-                    outrow[usemap[str(field)]] += '\n' + field + \
-                                                  ': ' + row[str(field)]
-                elif usemap[str(field)] in linekey:
-                    outrow[usemap[str(field)]] = field + ': ' + row[str(field)]
-            else:
-                outrow[usemap[str(field)]] = row[str(field)]
-        out.append(outrow)
-    return out
+            elif target not in outrow:
+                outrow[target] = value
+            elif join is not None:
+                outrow[target] += join + value
+        yield outrow
 
 
-class GetCustomers(object):
-    @staticmethod
-    def iscustomer(company):
-        book = GncFile.book
-        query = Query()
-        query.search_for('gncCustomer')
-        query.set_book(book)
+class Record(object):
+    """Fixed set of fields, each None until set, with no per-record dict.
 
-        for result in query.run():
-            customer = Customer(instance=result)
-            if customer.GetName() == company:
-                query.destroy()
-                return customer
-        query.destroy()
-        return None
+    Records pickle as a tuple of their fields, so parse_parallel can send
+    them between processes.
+    """
+    __slots__ = ()
 
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
 
-class GetVendors(object):
-    @staticmethod
-    def isvendor(company):
-        book = GncFile.book
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def items(self):
+        # The fields that are set, as (name, value) pairs
+        return [(name, getattr(self, name)) for name in self.__slots__
+                if getattr(self, name) is not None]
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in self.items()))
+
+
+class Document(Record):
+    """A QuickBooks document: its header row, DocumentEntries and tax rate.
+
+    Amounts and rates are (num, denom) pairs. paid is True for 'Paid' and
+    False when QuickBooks left it empty.
+    """
+    __slots__ = ('type', 'num', 'date_opened', 'owner', 'account', 'notes',
+                 'paid', 'amount', 'tax_table', 'tax_rate', 'entries')
+
+
+class DocumentEntry(Record):
+    """One detail row of a Document; quantity and price are (num, denom)."""
+    __slots__ = ('description', 'quantity', 'price', 'date', 'account',
+                 'amount', 'notes')
+
+
+def parse_document(document):
+    # Turn one document's mapped rows into a picklable Document.
+    # Amounts, quantities and prices are (num, denom) pairs.
+    new_rtype, date_opened = get_rtype(document[0])
+    new_rtype.entries = []
+
+    # Detail rows sit between the header and the total row
+    for row in document[1:-1]:
+        test, new_entry = get_entries(row, date_opened)
+        if test == 'tax_table':
+            new_rtype.tax_table, new_rtype.tax_rate = new_entry
+        elif test == 'entry':
+            new_rtype.entries.append(new_entry)
+    return new_rtype
+
+
+def parse_documents(rows):
+    for document in get_documents(rows):
+        yield parse_document(document)
+
+
+def parse_chunk(chunk):
+    # Worker side of parse_parallel: map and parse one chunk of raw rows
+    fieldnames, rows = chunk
+    return list(parse_documents(
+        mapqb2gnc(itertools.chain([fieldnames], rows), transmap)))
+
+
+def read_chunks(reader, size):
+    # Split raw transaction rows into chunks of about size documents,
+    # cutting only before a header row, so no document spans two chunks
+    fieldnames = next(reader)
+    typecol = fieldnames.index('Type')
+    chunk = []
+    documents = 0
+    for row in reader:
+        if not row:
+            continue
+        if len(row) > typecol and row[typecol]:
+            if documents == size:
+                yield fieldnames, chunk
+                chunk = []
+                documents = 0
+            documents += 1
+        chunk.append(row)
+    if chunk:
+        yield fieldnames, chunk
+
+
+def parse_parallel(reader, jobs, size=500):
+    # Map and parse chunks in a process pool and yield the documents in
+    # file order. Only a few chunks per worker are in flight at once.
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = deque()
+        for chunk in read_chunks(reader, size):
+            pending.append(pool.apply_async(parse_chunk, (chunk,)))
+            if len(pending) > 2 * jobs:
+                for new_rtype in pending.popleft().get():
+                    yield new_rtype
+        while pending:
+            for new_rtype in pending.popleft().get():
+                yield new_rtype
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_documents(rows):
+    # Group mapped transaction rows into complete QuickBooks documents.
+    # A document is a header row with a Type, detail rows with an Account
+    # and a total row with neither. Only the current document is kept.
+    document = None
+    for row in rows:
+        if 'type' in row:
+            # A header before the total row abandons the open document
+            document = [row]
+        elif document is not None:
+            document.append(row)
+            if 'account' not in row:
+                yield document
+                document = None
+
+
+class GetOwners(object):
+    """Index of the book's owners by company name and by ID.
+
+    The index is built once per GncFile session with a single Query and
+    kept current by new_customer/new_vendor, so lookups do not scan the
+    book. Subclasses choose the owner type.
+    """
+    search_type = ''
+    owner_class = None
+    # Snapshot attribute with the companies of this owner type
+    kind = ''
+    byname = {}
+    byid = {}
+
+    @classmethod
+    def build(cls):
+        cls.byname = {}
+        cls.byid = {}
         query = Query()
-        query.search_for('gncVendor')
-        query.set_book(book)
+        query.search_for(cls.search_type)
+        query.set_book(GncFile.book)
 
         for result in query.run():
-            vendor = Vendor(instance=result)
-            if vendor.GetName() == company:
-                query.destroy()
-                return vendor
+            cls.add(cls.owner_class(instance=result))
         query.destroy()
-        return None
 
+    @classmethod
+    def add(cls, owner):
+        # Keep the first owner found for a name, as the old scan did
+        cls.byname.setdefault(owner.GetName(), owner)
+        cls.byid.setdefault(owner.GetID(), owner)
 
-def gnc_numeric_from(any_value):
-    if str(any_value).find('%') != -1:
-        decimal_value = Decimal(any_value.strip('%'))
-        ispercent = True
-    else:
-        decimal_value = Decimal(any_value)
-        ispercent = False
-
-    sign, digits, exponent = decimal_value.as_tuple()
-
-    # convert decimal digits to a fractional numerator
-    # equivlent to
-    # numerator = int(''.join(digits))
-    # but without the wated conversion to string and back,
-    # this is probably the same algorithm int() uses
-    numerator = 0
-    TEN = int(Decimal(0).radix())  # this is always 10
-    numerator_place_value = 1
-    # add each digit to the final value multiplied by the place value
-    # from least significant to most sigificant
-    for i in xrange(len(digits) - 1, -1, -1):
-        numerator += digits[i] * numerator_place_value
-        numerator_place_value *= TEN
-
-    if decimal_value.is_signed():
-        numerator = -numerator
-
-    # if the exponent is negative, we use it to set the denominator
-    if exponent < 0:
-        denominator = TEN ** (-exponent)
-    # if the exponent isn't negative, we bump up the numerator
-    # and set the denominator to 1
-    else:
-        numerator *= TEN ** exponent
-        denominator = 1
-    if ispercent:
-        x = 100000 / denominator
-        numerator *= x
-        denominator *= x
-
-    return GncNumeric(numerator, denominator)
-
-
-def gnc_numeric_from_decimal(decimal_value):
-    sign, digits, exponent = decimal_value.as_tuple()
-
-    # convert decimal digits to a fractional numerator
-    # equivlent to
-    # numerator = int(''.join(digits))
-    # but without the wated conversion to string and back,
-    # this is probably the same algorithm int() uses
-    numerator = 0
-    TEN = int(Decimal(0).radix())  # this is always 10
-    numerator_place_value = 1
-    # add each digit to the final value multiplied by the place value
-    # from least significant to most sigificant
-    for i in xrange(len(digits) - 1, -1, -1):
-        numerator += digits[i] * numerator_place_value
-        numerator_place_value *= TEN
-
-    if decimal_value.is_signed():
-        numerator = -numerator
-
-    # if the exponent is negative, we use it to set the denominator
-    if exponent < 0:
-        denominator = TEN ** (-exponent)
-    # if the exponent isn't negative, we bump up the numerator
-    # and set the denominator to 1
-    else:
-        numerator *= TEN ** exponent
-        denominator = 1
+    @classmethod
+    def reindex(cls, owner, oldname, oldid):
+        # Drop the keys the owner was filed under before a rename
+        if cls.byname.get(oldname) is owner:
+            del cls.byname[oldname]
+        if cls.byid.get(oldid) is owner:
+            del cls.byid[oldid]
+        cls.add(owner)
 
-    return GncNumeric(numerator, denominator)
+    @classmethod
+    def lookup_id(cls, cid):
+        return cls.byid.get(cid)
 
+    @classmethod
+    def lookup_name(cls, company):
+        return cls.byname.get(company)
 
-def get_rtype(row):
-    new_rtype = {}
-    if 'num' in row.keys():
-        new_rtype['num'] = row['num']
-    dt_str = '%m/%d/%Y'
-    date_opened = datetime.datetime.strptime(row['date_opened'], dt_str)
-    new_rtype['date_opened'] = date_opened
-    if 'owner' in row.keys():
-        new_rtype['owner'] = row['owner']
-    elif 'notes' in row.keys():
-        new_rtype['owner'] = row['notes']
-
-    new_rtype['account'] = row['account']
+    @classmethod
+    def classify(cls, row):
+        # Match a row with a company to the index: returns the action
+        # ('create', 'update-company', 'update-id' or 'unchanged'), the
+        # owner found and the ID to use ('' to take the next free one)
+        cid = ''
+        testcompany = cls.byname.get(row['company'])
+        if testcompany is not None:
+            cid = testcompany.GetID()
+
+        if 'id' in row:
+            if row['id'] != cid:
+                cid = row['id']
+                testid = cls.byid.get(cid)
+            else:
+                testid = testcompany
+        else:
+            testid = None
+
+        if testid is None and testcompany is None:
+            # Owner not found, create
+            return 'create', None, cid
+        elif testid == testcompany:
+            # ID and Company match, use
+            return 'unchanged', testid, cid
+        elif testid is not None and testcompany is None:
+            # Owner found by ID, update Company
+            return 'update-company', testid, cid
+        elif not cid or cid == testcompany.GetID():
+            # Owner found by Company, ID missing, use
+            return 'unchanged', testcompany, cid
+        else:
+            # Owner found by Company, update ID
+            return 'update-id', testcompany, cid
 
-    if 'notes' in row.keys():
-        new_rtype['notes'] = row['notes']
-    if 'paid' in row.keys():
+    @classmethod
+    def resolve(cls, book, USD, action, owner, company, cid):
+        # Apply an action from classify and return the owner
+        if action == 'create':
+            if not cid:
+                cid = cls.next_id(book)
+            owner = cls.owner_class(book, cid, USD, company)
+            cls.add(owner)
+        elif action == 'update-company':
+            oldname = owner.GetName()
+            owner.SetCompany(company)
+            cls.reindex(owner, oldname, cid)
+        elif action == 'update-id':
+            oldid = owner.GetID()
+            owner.SetID(cid)
+            cls.reindex(owner, company, oldid)
+        return owner
+
+    @classmethod
+    def changed(cls, owner, row):
+        # True if new_customer/new_vendor would change any detail of owner
+        addresses = {}
+        for key, addr, getter in cls.details:
+            if key in row:
+                if addr not in addresses:
+                    addresses[addr] = getattr(owner, addr)()
+                if getattr(addresses[addr], getter)() != row[key]:
+                    return True
+        if 'notes' in row and owner.GetNotes() != str(row['notes']):
+            return True
+        if 'tax item' in row and 'sales tax code' in row:
+            table = owner.GetTaxTable()
+            if table is None or table.GetName() != row['tax item'] or \
+                    owner.GetTaxTableOverride() != (row['sales tax code'] != 'Non'):
+                return True
+        return False
+
+    @classmethod
+    def bulk(cls, book, rows, new_owner, USD):
+        # Diff every row against the index first, then apply only the rows
+        # that change something, in order, with new_owner
+        counts = OrderedDict((action, 0) for action in (
+            'create', 'update-company', 'update-id', 'update-details',
+            'unchanged'))
+        changes = []
+        touched = set()
+        for row in rows:
+            if 'company' not in row:
+                print "Company missing in %s" % row
+                continue
+            action, owner, cid = cls.classify(row)
+            if action == 'unchanged':
+                # An owner an earlier row changes is applied again, in order
+                if id(owner) not in touched and not cls.changed(owner, row):
+                    counts['unchanged'] += 1
+                    continue
+                action = 'update-details'
+            counts[action] += 1
+            if owner is not None:
+                touched.add(id(owner))
+            changes.append(row)
+
+        for row in changes:
+            new_owner(book, row, USD)
+        print ', '.join('%s: %d' % item for item in counts.iteritems())
+        return counts
+
+
+class GetCustomers(GetOwners):
+    search_type = 'gncCustomer'
+    kind = 'customers'
+    owner_class = Customer
+    byname = {}
+    byid = {}
+    # Row key, address and getter of the details new_customer sets
+    details = (('name', 'GetAddr', 'GetName'), ('addr1', 'GetAddr', 'GetAddr1'),
+               ('addr2', 'GetAddr', 'GetAddr2'), ('addr3', 'GetAddr', 'GetAddr3'),
+               ('addr4', 'GetAddr', 'GetAddr4'), ('phone', 'GetAddr', 'GetPhone'),
+               ('fax', 'GetAddr', 'GetFax'), ('email', 'GetAddr', 'GetEmail'),
+               ('shipname', 'GetShipAddr', 'GetName'), ('shipaddr1', 'GetShipAddr', 'GetAddr1'),
+               ('shipaddr2', 'GetShipAddr', 'GetAddr2'), ('shipaddr3', 'GetShipAddr', 'GetAddr3'),
+               ('shipaddr4', 'GetShipAddr', 'GetAddr4'), ('shipphone', 'GetShipAddr', 'GetPhone'))
+
+    @classmethod
+    def next_id(cls, book):
+        return book.CustomerNextID()
+
+    @classmethod
+    def iscustomer(cls, company):
+        return cls.byname.get(company)
+
+
+class GetVendors(GetOwners):
+    search_type = 'gncVendor'
+    kind = 'vendors'
+    owner_class = Vendor
+    byname = {}
+    byid = {}
+    # Row key, address and getter of the details new_vendor sets
+    details = (('name', 'GetAddr', 'GetName'), ('addr1', 'GetAddr', 'GetAddr1'),
+               ('addr2', 'GetAddr', 'GetAddr2'), ('addr3', 'GetAddr', 'GetAddr3'),
+               ('addr4', 'GetAddr', 'GetAddr4'), ('phone', 'GetAddr', 'GetPhone'),
+               ('fax', 'GetAddr', 'GetFax'), ('email', 'GetAddr', 'GetEmail'))
+
+    @classmethod
+    def next_id(cls, book):
+        return book.VendorNextID()
+
+    @classmethod
+    def isvendor(cls, company):
+        return cls.byname.get(company)
+
+
+class Posters(object):
+    # QuickBooks Type -> (poster, owners, planner). A poster posts one whole
+    # Document with (book, document, USD) and returns the GnuCash ID it
+    # created ('' if none), or None if it skipped the document. owners is
+    # GetCustomers or GetVendors for types that need an existing owner, and
+    # planner(snapshot, document) tells plan_transactions what the poster
+    # would do. Ignored types map to None; any other type gets the default.
+    registry = {}
+    default = None
+
+    @classmethod
+    def register(cls, rtypes, poster, owners=None, planner=None):
+        for rtype in rtypes:
+            cls.registry[rtype] = (poster, owners, planner)
+
+    @classmethod
+    def ignore(cls, *rtypes):
+        for rtype in rtypes:
+            cls.registry[rtype] = None
+
+    @classmethod
+    def entry(cls, rtype):
+        return cls.registry.get(rtype, cls.default)
+
+    @classmethod
+    def lookup(cls, rtype):
+        entry = cls.entry(rtype)
+        if entry is not None:
+            return entry[0]
+
+    @classmethod
+    def ignored(cls, rtype):
+        return rtype in cls.registry and cls.registry[rtype] is None
+
+
+Posters.default = (post_journal, None, plan_journal)
+Posters.register(('Invoice',), post_invoice, GetCustomers, plan_invoice)
+Posters.register(('Bill', 'Credit'), post_bill, GetVendors, plan_bill)
+Posters.register(('Payment',), post_customer_payment, GetCustomers, plan_payment)
+Posters.register(('Bill Pmt -CCard',), post_vendor_payment, GetVendors, plan_payment)
+Posters.ignore('Paycheck')
+
+
+class Accounts(object):
+    """Index of the book's accounts by full name and by leaf name.
+
+    lookup() answers from the index instead of walking the account tree
+    for every split and entry. The index is built when GncFile opens the
+    book and again after invalidate(), which new_tax calls when it adds
+    an account. Leaf names resolve to the same account
+    root.lookup_by_name would find.
+    """
+    root = None
+    byfullname = {}
+    byname = {}
+    current = False
+    lookups = 0
+    rebuilds = 0
+    failures = 0
+
+    @classmethod
+    def build(cls, root):
+        cls.root = root
+        cls.byfullname = {}
+        cls.byname = {}
+        cls._index(root, '')
+        cls.current = True
+
+    @classmethod
+    def _index(cls, parent, prefix):
+        # Children before grandchildren, matching lookup_by_name
+        children = parent.get_children()
+        for child in children:
+            cls.byname.setdefault(child.GetName(), child)
+        for child in children:
+            fullname = prefix + child.GetName()
+            cls.byfullname[fullname] = child
+            cls._index(child, fullname + ':')
+
+    @classmethod
+    def invalidate(cls):
+        cls.current = False
+
+    @classmethod
+    def lookup(cls, name, row=None):
+        started = Profile.start()
+        cls.lookups += 1
+        if not cls.current:
+            cls.rebuilds += 1
+            cls.build(cls.root)
+        account = cls.byfullname.get(name)
+        if account is None:
+            account = cls.byname.get(name)
+        if account is None:
+            cls.failures += 1
+            print 'Account "%s" does not exist, QuickBooks row: %s' % \
+                  (name, row)
+            raise Exception('GnuCash account missing')
+        Profile.stop('account lookup', started)
+        return account
+
+    @classmethod
+    def report(cls):
+        if cls.lookups:
+            print "Account lookups: %d, index rebuilds: %d, " \
+                  "missing accounts: %d" % (cls.lookups, cls.rebuilds,
+                                            cls.failures)
+
+
+class Profile(object):
+    # Wall-clock seconds of each posting phase and each document, kept by
+    # new_transaction only when enabled (--profile). Phases do not overlap:
+    # Entry and PostToAccount exclude their account lookups.
+    enabled = False
+    phases = {}
+    documents = {}
+    started = None
+
+    @classmethod
+    def enable(cls):
+        Profile.enabled = True
+        Profile.phases = {}
+        Profile.documents = {}
+        Profile.started = time.time()
+
+    @classmethod
+    def start(cls):
+        # Returns None when disabled, which stop and document ignore
+        if Profile.enabled:
+            return time.time()
+
+    @classmethod
+    def stop(cls, phase, started):
+        if started is not None:
+            Profile.phases.setdefault(phase, []).append(time.time() - started)
+
+    @classmethod
+    def document(cls, rtype, started):
+        if started is not None:
+            Profile.documents.setdefault(rtype, []).append(
+                time.time() - started)
+
+    @classmethod
+    def summary(cls, samples):
+        samples = sorted(samples)
+
+        def percentile(p):
+            # Nearest rank: the ceil(p% of n)th sample
+            return samples[max(0, int(math.ceil(p * len(samples) / 100.0)) - 1)]
+
+        total = sum(samples)
+        return OrderedDict((
+            ('count', len(samples)), ('total', total),
+            ('mean', total / len(samples)), ('p50', percentile(50)),
+            ('p90', percentile(90)), ('p99', percentile(99)),
+            ('max', samples[-1])))
+
+    @classmethod
+    def report(cls, path):
+        # Write the JSON report to path and print a summary table
+        if not Profile.enabled:
+            return
+        report = OrderedDict((
+            ('elapsed', time.time() - Profile.started),
+            ('documents', OrderedDict(
+                (rtype, Profile.summary(samples))
+                for rtype, samples in sorted(Profile.documents.items()))),
+            ('phases', OrderedDict(
+                (phase, Profile.summary(samples))
+                for phase, samples in sorted(Profile.phases.items())))))
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        for section in ('documents', 'phases'):
+            print '%-18s %8s %9s %9s %9s %9s' % (section, 'count', 'total s',
+                                                 'p50 ms', 'p90 ms', 'p99 ms')
+            for name, stats in report[section].iteritems():
+                print '%-18s %8d %9.2f %9.3f %9.3f %9.3f' % (
+                    name[:18], stats['count'], stats['total'],
+                    1000 * stats['p50'], 1000 * stats['p90'],
+                    1000 * stats['p99'])
+        print 'Profile of %.2f s written to %s' % (report['elapsed'], path)
+
+
+def gnc_numeric_from(any_value):
+    # Amounts, quantities, prices and tax percentages as GncNumeric
+    return GncNumeric(*numeric_parts(any_value))
+
+
+def get_rtype(row):
+    new_rtype = Document(num=row.get('num'), account=row['account'],
+                         notes=row.get('notes'), type=row['type'])
+    try:
+        date_opened = parse_date(row['date_opened'])
+    except ValueError as e:
+        print 'Date %s, QuickBooks row: %s' % (e, row)
+        raise Exception('QuickBooks date not understood')
+    new_rtype.date_opened = date_opened
+    if 'owner' in row:
+        new_rtype.owner = row['owner']
+    elif 'notes' in row:
+        new_rtype.owner = row['notes']
+
+    if 'paid' in row:
         if row['paid'] == 'Paid':
-            new_rtype['paid'] = True
+            new_rtype.paid = True
     else:
-        new_rtype['paid'] = False
+        new_rtype.paid = False
 
-    if 'amount' in row.keys():
-        new_rtype['amount'] = gnc_numeric_from(row['amount'])
-    new_rtype['type'] = row['type']
+    if 'amount' in row:
+        new_rtype.amount = numeric_parts(row['amount'])
 
     return new_rtype, date_opened
 
 
 def get_entries(row, date_opened):
-    entry = {}
-    if row['account'] == 'Sales Tax Payable' and 'price' in row.keys():
-        entry['tax_table'] = row['item']
-        entry['price'] = gnc_numeric_from(row['price'])
-        TaxRates.israte(entry['tax_table'], entry['price'])
-        return 'tax_table', entry
-
-    if 'description' in row.keys():
-        entry['description'] = row['description']
-    elif 'owner' in row.keys():
-        entry['description'] = row['owner']
-    elif 'notes' in row.keys():
-        entry['description'] = row['notes']
-
-    if 'quantity' in row.keys():
-        entry['quantity'] = \
-            gnc_numeric_from(abs(Decimal(row['quantity'])))
-        if 'price' in row.keys():
-            entry['price'] = gnc_numeric_from(row['price'])
-
-    entry['date'] = date_opened
-    if row['account'] == 'Sales Tax Payable' and 'item' in row.keys():
-        entry['account'] = row['item']
+    # ('tax_table', (item, rate)) for a sales tax row, else ('entry', DocumentEntry)
+    if row['account'] == 'Sales Tax Payable' and 'price' in row:
+        return 'tax_table', (row['item'], numeric_parts(row['price']))
+
+    entry = DocumentEntry(date=date_opened, notes=row.get('notes'))
+    if 'description' in row:
+        entry.description = row['description']
+    elif 'owner' in row:
+        entry.description = row['owner']
+    elif 'notes' in row:
+        entry.description = row['notes']
+
+    if 'quantity' in row:
+        entry.quantity = numeric_parts(abs(Decimal(row['quantity'])))
+        if 'price' in row:
+            entry.price = numeric_parts(row['price'])
+
+    if row['account'] == 'Sales Tax Payable' and 'item' in row:
+        entry.account = row['item']
     else:
-        entry['account'] = row['account']
+        entry.account = row['account']
 
-    if 'amount' in row.keys():
-        entry['amount'] = gnc_numeric_from(row['amount'])
-
-    if 'notes' in row.keys():
-        entry['notes'] = row['notes']
+    if 'amount' in row:
+        entry.amount = numeric_parts(row['amount'])
 
     return 'entry', entry
 
@@ -1048,6 +1684,11 @@ class GncFile(object):
             GncFile.commod_table = GncFile.book.get_table()
             GncFile.USD = GncFile.commod_table.lookup('CURRENCY', 'USD')
 
+            # Owner objects do not survive the session, so index them again
+            GetCustomers.build()
+            GetVendors.build()
+            Accounts.build(GncFile.root)
+
             GncFile.status = True
             return GncFile.status
 
@@ -1055,6 +1696,8 @@ class GncFile(object):
     def gnc_save(cls):
         if GncFile.status and GncFile.nosave:
             GncFile.s.save()
+            # Only documents that reached the book count as posted
+            Posted.commit()
 
     @classmethod
     def gnc_end(cls):
@@ -1062,73 +1705,463 @@ class GncFile(object):
         GncFile.status = False
 
 
+class Posted(object):
+    # Fingerprints of the documents already posted to a book, kept in SQLite
+    # so a re-run of the same export skips them. A fingerprint hashes type,
+    # num, owner, date, amount and how many earlier documents in the export
+    # share them; the digest hashes the whole document to spot changes.
+    db = None
+    known = {}
+    pending = []
+    progress = None
+    occurrences = {}
+    current = None
+    # posted counts committed documents, unsaved those posted since
+    counts = {'posted': 0, 'unsaved': 0, 'skipped': 0, 'changed': 0}
+
+    @classmethod
+    def open(cls, path):
+        Posted.db = sqlite3.connect(path)
+        Posted.db.execute(
+            'CREATE TABLE IF NOT EXISTS posted (fingerprint TEXT PRIMARY KEY, '
+            'digest TEXT, gnc_id TEXT, type TEXT, num TEXT, owner TEXT, '
+            'date TEXT)')
+        Posted.db.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoint (export TEXT PRIMARY KEY, '
+            'documents INTEGER, last TEXT, saved TEXT)')
+        Posted.known = dict(
+            (fingerprint, (digest, gnc_id)) for fingerprint, digest, gnc_id in
+            Posted.db.execute('SELECT fingerprint, digest, gnc_id FROM posted'))
+        Posted.pending = []
+        Posted.progress = None
+        Posted.occurrences = {}
+        Posted.counts = {'posted': 0, 'unsaved': 0, 'skipped': 0, 'changed': 0}
+
+    @classmethod
+    def fingerprint(cls, document):
+        fields = (document.type, document.num or '', document.owner or '',
+                  document.date_opened.isoformat(), repr(document.amount))
+        occurrence = Posted.occurrences.get(fields, 0)
+        Posted.occurrences[fields] = occurrence + 1
+        fingerprint = hashlib.sha1(repr(fields + (occurrence,))).hexdigest()
+        digest = hashlib.sha1(repr(
+            [sorted(item for item in document.items() if item[0] != 'entries')] +
+            [sorted(entry.items()) for entry in document.entries]
+        )).hexdigest()
+        return fingerprint, digest
+
+    @classmethod
+    def skip(cls, document):
+        # True if this document was posted by an earlier run, unchanged
+        if Posted.db is None:
+            return False
+        fingerprint, digest = Posted.fingerprint(document)
+        Posted.current = (fingerprint, digest, document)
+        if fingerprint not in Posted.known:
+            return False
+        if Posted.known[fingerprint][0] == digest:
+            Posted.counts['skipped'] += 1
+            return True
+        print '%s %s %s changed since it was posted as %s; posting it again' % \
+              (document.type, document.num or '', document.owner or '',
+               Posted.known[fingerprint][1] or 'a transaction')
+        Posted.counts['changed'] += 1
+        return False
+
+    @classmethod
+    def add(cls, gnc_id=None):
+        # Record the document last passed to skip as posted
+        if Posted.db is None:
+            return
+        fingerprint, digest, document = Posted.current
+        Posted.known[fingerprint] = (digest, gnc_id)
+        Posted.pending.append((
+            fingerprint, digest, gnc_id, document.type, document.num,
+            document.owner, document.date_opened.isoformat()))
+        Posted.counts['unsaved'] += 1
+
+    @classmethod
+    def commit(cls):
+        if Posted.db is None:
+            return
+        Posted.db.executemany(
+            'INSERT OR REPLACE INTO posted VALUES (?, ?, ?, ?, ?, ?, ?)',
+            Posted.pending)
+        if Posted.progress is not None:
+            Posted.db.execute(
+                'INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?, ?)',
+                Posted.progress + (datetime.datetime.now().isoformat(),))
+        Posted.db.commit()
+        Posted.counts['posted'] += len(Posted.pending)
+        Posted.counts['unsaved'] = 0
+        Posted.pending = []
+
+    @classmethod
+    def reached(cls, export, documents, mark):
+        # Documents of export handled so far and the mark of the last one,
+        # saved with the next commit
+        if Posted.db is not None:
+            Posted.progress = (os.path.abspath(export), documents, mark)
+
+    @classmethod
+    def checkpoint(cls, export):
+        # (documents, mark) of export as of the last save, or (0, None)
+        if Posted.db is None:
+            return 0, None
+        row = Posted.db.execute(
+            'SELECT documents, last FROM checkpoint WHERE export = ?',
+            (os.path.abspath(export),)).fetchone()
+        if row is None:
+            return 0, None
+        return row
+
+    @classmethod
+    def close(cls):
+        # Anything not committed by gnc_save is forgotten. main closes the
+        # store, not gnc_end: ReplaceTax.replace ends and reopens sessions.
+        if Posted.db is None:
+            return
+        Posted.db.close()
+        Posted.db = None
+        if any(Posted.counts.values()):
+            print '%(posted)d documents posted, %(skipped)d already posted ' \
+                  'skipped, %(changed)d changed' % Posted.counts
+        if Posted.counts.get('unsaved'):
+            print '%(unsaved)d documents posted but not saved' % Posted.counts
+
+
+GncTags = namedtuple('GncTags', (
+    'book', 'taxtable', 'taxtableentry', 'invoice', 'entry', 'invoice_id',
+    'invoice_guid', 'taxtable_name', 'taxtable_guid', 'taxtable_entries',
+    'tte_amount', 'entry_invoice', 'entry_itaxtable', 'account', 'act_name',
+    'act_id', 'act_type', 'act_parent', 'customer', 'cust_name', 'cust_id',
+    'vendor', 'vendor_name', 'vendor_id'))
+
+
+class Snapshot(object):
+    """Read-only copy of what posting looks up in a book.
+
+    Customer and vendor IDs by company, account full names and the rate
+    of each tax table, read from a GnuCash XML book without a session or
+    from a JSON snapshot saved earlier. plan_transactions checks an export
+    against it instead of the book.
+    """
+
+    def __init__(self, customers, vendors, accounts, taxtables):
+        # lxml and json give unicode for non-ASCII text; keep names as the
+        # UTF-8 str the csv rows and the bindings use
+        self.customers = dict((utf8(name), utf8(cid)) for name, cid in customers.iteritems())
+        self.vendors = dict((utf8(name), utf8(cid)) for name, cid in vendors.iteritems())
+        accounts = [utf8(name) for name in accounts]
+        self.accounts = set(accounts)
+        self.taxtables = dict((utf8(name), rate) for name, rate in taxtables.iteritems())
+        # Leaf names resolve like Accounts.lookup
+        self.names = set(name.rsplit(':', 1)[-1] for name in accounts)
+
+    @classmethod
+    def from_book(cls, path):
+        customers = {}
+        vendors = {}
+        parents = {}
+        taxtables = {}
+        for t, child in ReplaceTax.iterbook(path):
+            if child.tag == t.account:
+                parents[child.findtext(t.act_id)] = (
+                    child.findtext(t.act_name), child.findtext(t.act_parent),
+                    child.findtext(t.act_type))
+            elif child.tag == t.customer:
+                customers[child.findtext(t.cust_name)] = child.findtext(t.cust_id)
+            elif child.tag == t.vendor:
+                vendors[child.findtext(t.vendor_name)] = child.findtext(t.vendor_id)
+            elif child.tag == t.taxtable:
+                amount = child.findtext('.//' + t.tte_amount)
+                if amount is not None:
+                    num, denom = (amount.split('/') + ['1'])[:2]
+                    amount = (int(num), int(denom))
+                taxtables[child.findtext(t.taxtable_name)] = amount
+
+        fullnames = {}
+
+        def fullname(guid):
+            # Full name of an account below the root, or None for the root
+            if guid not in fullnames:
+                name, parent, atype = parents[guid]
+                if atype == 'ROOT':
+                    fullnames[guid] = None
+                else:
+                    prefix = fullname(parent) if parent in parents else None
+                    fullnames[guid] = name if prefix is None else prefix + ':' + name
+            return fullnames[guid]
+
+        accounts = [name for name in map(fullname, parents) if name is not None]
+        return cls(customers, vendors, accounts, taxtables)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        taxtables = dict((name, rate and tuple(rate))
+                         for name, rate in data['taxtables'].iteritems())
+        return cls(data['customers'], data['vendors'], data['accounts'], taxtables)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'customers': self.customers, 'vendors': self.vendors,
+                       'accounts': sorted(self.accounts), 'taxtables': self.taxtables}, f)
+
+    @classmethod
+    def open(cls, book, snapshot=None):
+        # Use snapshot if it is newer than the book, otherwise read the book
+        # and save it to snapshot for the next run
+        if snapshot is not None and os.path.exists(snapshot) and \
+                (not os.path.exists(book) or os.path.getmtime(snapshot) >= os.path.getmtime(book)):
+            return cls.load(snapshot)
+        with open(book, 'rb') as f:
+            if f.read(15) == 'SQLite format 3':
+                raise Exception('Planning needs an XML book or a --snapshot of one, not %s' % book)
+        result = cls.from_book(book)
+        if snapshot is not None:
+            result.save(snapshot)
+        return result
+
+    def account(self, name):
+        return name in self.accounts or name in self.names
+
+    def owners(self, kind):
+        # Companies of a GetCustomers or GetVendors kind of owner
+        return getattr(self, kind.kind)
+
+
+def utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def is_gzip(path):
+    # GnuCash compresses XML books unless told not to
+    with open(path, 'rb') as f:
+        return f.read(2) == '\x1f\x8b'
+
+
+def open_book(path, mode='rb', compressed=None):
+    if compressed is None:
+        compressed = is_gzip(path)
+    if compressed:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
 class ReplaceTax(object):
     invoice_list = {}
+    tagcache = {}
 
     @classmethod
     def invoice(cls, invoiceid, rate):
         ReplaceTax.invoice_list[str(invoiceid)] = rate.to_string()
 
     @classmethod
-    def replace(cls, outfile):
+    def tags(cls, nsmap):
+        # Element names only depend on the namespaces, so build them once
+        key = tuple(sorted(nsmap.items()))
+        if key not in cls.tagcache:
+            def tag(prefix, name):
+                # A book only declares the namespaces it uses
+                return '{' + nsmap.get(prefix, 'http://www.gnucash.org/XML/' + prefix) + '}' + name
+
+            cls.tagcache[key] = GncTags(
+                book=tag('gnc', 'book'),
+                taxtable=tag('gnc', 'GncTaxTable'),
+                taxtableentry=tag('gnc', 'GncTaxTableEntry'),
+                invoice=tag('gnc', 'GncInvoice'),
+                entry=tag('gnc', 'GncEntry'),
+                invoice_id=tag('invoice', 'id'),
+                invoice_guid=tag('invoice', 'guid'),
+                taxtable_name=tag('taxtable', 'name'),
+                taxtable_guid=tag('taxtable', 'guid'),
+                taxtable_entries=tag('taxtable', 'entries'),
+                tte_amount=tag('tte', 'amount'),
+                entry_invoice=tag('entry', 'invoice'),
+                entry_itaxtable=tag('entry', 'i-taxtable'),
+                account=tag('gnc', 'account'),
+                act_name=tag('act', 'name'),
+                act_id=tag('act', 'id'),
+                act_type=tag('act', 'type'),
+                act_parent=tag('act', 'parent'),
+                customer=tag('gnc', 'GncCustomer'),
+                cust_name=tag('cust', 'name'),
+                cust_id=tag('cust', 'id'),
+                vendor=tag('gnc', 'GncVendor'),
+                vendor_name=tag('vendor', 'name'),
+                vendor_id=tag('vendor', 'id'))
+        return cls.tagcache[key]
+
+    @classmethod
+    def replace(cls, outfile, stream=False):
+        # stream rewrites the book without loading it, for large books
         GncFile.gnc_save()
         GncFile.gnc_end()
 
-        tree = et.parse(outfile)
-        root = tree.getroot()
-
-        xmlgnc = root.nsmap['gnc']
-        xmlgncbook = '{' + xmlgnc + '}book'
-        xmlgnctaxtable = '{' + xmlgnc + '}GncTaxTable'
-        xmlgnctaxtableentry = '{' + xmlgnc + '}GncTaxTableEntry'
-        xmlgncinvoice = '{' + xmlgnc + '}GncInvoice'
-        xmlgncentry = '{' + xmlgnc + '}GncEntry'
-
-        xmlinvoice = root.nsmap['invoice']
-        xmlinvoice_id = '{' + xmlinvoice + '}id'
-        xmlinvoice_guid = '{' + xmlinvoice + '}guid'
+        if stream:
+            changed = cls.replace_stream(outfile)
+        else:
+            changed = cls.replace_tree(outfile)
+        print '%d tax table entries changed' % changed
 
-        xmltaxtable = root.nsmap['taxtable']
-        xmltaxtable_name = '{' + xmltaxtable + '}name'
-        xmltaxtable_guid = '{' + xmltaxtable + '}guid'
-        xmltaxtable_entries = '{' + xmltaxtable + '}entries'
+        GncFile.gnc_open()
 
-        xmltte_amount = '{' + root.nsmap['tte'] + '}amount'
+    @classmethod
+    def replace_tree(cls, outfile):
+        tree = et.parse(outfile)
+        root = tree.getroot()
+        t = cls.tags(root.nsmap)
+        book = root.find(t.book)
+
+        # Index invoices, entries and tax tables in one pass over the book
+        invoices = {}
+        invoice_taxtables = {}
+        taxtables = {}
+        for child in book.iter(t.invoice, t.entry, t.taxtable):
+            if child.tag == t.invoice:
+                invoices[child.findtext(t.invoice_id)] = \
+                    child.findtext(t.invoice_guid)
+            elif child.tag == t.entry:
+                guid = child.findtext(t.entry_invoice)
+                itaxtable = child.findtext(t.entry_itaxtable)
+                if guid is not None and itaxtable is not None:
+                    invoice_taxtables.setdefault(guid, set()).add(itaxtable)
+            else:
+                taxtables[child.findtext(t.taxtable_guid)] = child
 
-        xmlentry = root.nsmap['entry']
-        xmlentry_invoice = '{' + xmlentry + '}invoice'
-        xmlentry_itaxtable = '{' + xmlentry + '}i-taxtable'
+        changed = 0
+        for cid, rate in ReplaceTax.invoice_list.iteritems():
+            guid = invoices.get(str(cid))
+            if guid is None:
+                print 'Invoice %s not found in %s' % (cid, outfile)
+                continue
+            for itaxtable in invoice_taxtables.get(guid, ()):
+                child = taxtables[itaxtable]
+                name = child.findtext(t.taxtable_name)
+                entries = child.find(t.taxtable_entries)
+                for entry in entries.findall(t.taxtableentry):
+                    amount = entry.find(t.tte_amount)
+                    if amount.text != rate:
+                        print '%s (%s) rate: %s -> %s' % (
+                            name, itaxtable, amount.text, rate)
+                        amount.text = rate
+                        changed += 1
 
-        book = root.find(xmlgncbook)
-        for cid in ReplaceTax.invoice_list:
-            for child in book.iter(xmlgncinvoice):
-                if child.find(xmlinvoice_id).text == str(cid):
-                    guid = child.find(xmlinvoice_guid).text
-
-            for child in book.iter(xmlgncentry):
-                if child.find(xmlentry_invoice).text == guid:
-                    itaxtable = child.find(xmlentry_itaxtable).text
-
-            for child in book.iter(xmlgnctaxtable):
-                if child.find(xmltaxtable_guid).text == itaxtable:
-                    name = child.find(xmltaxtable_name)
-                    entries = child.find(xmltaxtable_entries)
-                    for entry in entries.findall(xmlgnctaxtableentry):
-                        print name.text, itaxtable
-                        amount = entry.find(xmltte_amount)
-                        print amount.text
-                        amount.text = str(ReplaceTax.invoice_list[str(cid)])
-                        print amount.text
-
-                        # out = ET.tostring(tree, xml_declaration=True, pretty_print=True,
-                        # encoding='utf-8')
-                        # print out
         tree.write(outfile,
                    xml_declaration=True,
                    pretty_print=True,
                    encoding='utf-8')
+        return changed
 
-        GncFile.gnc_open()
+    @classmethod
+    def iterbook(cls, path):
+        # Yield (tags, element) for each completed child of gnc:book and
+        # clear it afterwards, so memory does not grow with the book
+        source = open_book(path)
+        try:
+            t = None
+            depth = 0
+            for event, element in et.iterparse(source,
+                                               events=('start', 'end')):
+                if event == 'start':
+                    if t is None:
+                        t = cls.tags(element.nsmap)
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 2:
+                    yield t, element
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+        finally:
+            source.close()
+
+    @classmethod
+    def replace_stream(cls, outfile):
+        # Find the invoices' guids and the source line of every tax table
+        # amount, then the tax tables used by those invoices' entries, then
+        # copy the book line by line rewriting only those amounts. The
+        # rest of the file is copied byte for byte.
+        guids = {}
+        amountlines = {}
+        names = {}
+        taxtables = {}
+        early_entries = False
+        for t, child in cls.iterbook(outfile):
+            if child.tag == t.invoice:
+                cid = child.findtext(t.invoice_id)
+                if cid in ReplaceTax.invoice_list:
+                    guids[child.findtext(t.invoice_guid)] = cid
+            elif child.tag == t.entry:
+                guid = child.findtext(t.entry_invoice)
+                itaxtable = child.findtext(t.entry_itaxtable)
+                if guid in guids and itaxtable is not None:
+                    taxtables.setdefault(itaxtable, set()).add(guids[guid])
+                elif len(guids) < len(ReplaceTax.invoice_list):
+                    early_entries = True
+            elif child.tag == t.taxtable:
+                guid = child.findtext(t.taxtable_guid)
+                names[guid] = child.findtext(t.taxtable_name)
+                amountlines[guid] = [
+                    amount.sourceline for amount in child.iter(t.tte_amount)]
+
+        for cid in ReplaceTax.invoice_list:
+            if cid not in guids.values():
+                print 'Invoice %s not found in %s' % (cid, outfile)
+
+        if early_entries:
+            # Entries written before their invoices need a second look
+            for t, child in cls.iterbook(outfile):
+                if child.tag == t.entry:
+                    guid = child.findtext(t.entry_invoice)
+                    itaxtable = child.findtext(t.entry_itaxtable)
+                    if guid in guids and itaxtable is not None:
+                        taxtables.setdefault(itaxtable, set()).add(
+                            guids[guid])
+
+        rewrite = {}
+        for itaxtable, cids in taxtables.iteritems():
+            for cid in sorted(cids):
+                for line in amountlines[itaxtable]:
+                    rewrite[line] = (names[itaxtable], itaxtable,
+                                     ReplaceTax.invoice_list[cid])
+        if not rewrite:
+            return 0
+
+        changed = 0
+        compressed = is_gzip(outfile)
+        tmpfile = outfile + '.tmp'
+        source = open_book(outfile, 'rb', compressed)
+        target = open_book(tmpfile, 'wb', compressed)
+        try:
+            for lineno, line in enumerate(source, 1):
+                if lineno in rewrite:
+                    name, itaxtable, rate = rewrite[lineno]
+                    match = AMOUNT_TEXT.search(line)
+                    if match is None:
+                        raise Exception('Tax table amount not found on '
+                                        'line %d of %s' % (lineno, outfile))
+                    if match.group(1) != rate:
+                        print '%s (%s) rate: %s -> %s' % (
+                            name, itaxtable, match.group(1), rate)
+                        line = line[:match.start(1)] + rate + \
+                            line[match.end(1):]
+                        changed += 1
+                target.write(line)
+        except:
+            target.close()
+            os.remove(tmpfile)
+            raise
+        finally:
+            source.close()
+        target.close()
+        os.rename(tmpfile, outfile)
+        return changed
 
 
 if __name__ == "__main__":